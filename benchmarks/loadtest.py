@@ -0,0 +1,268 @@
+"""
+Offline http load test.
+
+Starts the app in a subprocess against a seeded sqlite db, a seeded image
+directory and a local fake spotify, then runs concurrent load against each
+route and reports rps and p50/p95/p99 latency per route.
+
+    python benchmarks/loadtest.py --users 10000 --concurrency 50 --duration 10
+    python benchmarks/loadtest.py --cron  # with the cron polling every user
+
+With --cron the fake spotify returns a new play on every poll, so every
+seeded user gets rendered over and over while the routes are under load.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ROUTES = ("index", "signup", "create", "image")
+
+# 1x1 transparent gif
+TINY_GIF = bytes.fromhex(
+    "47494638396101000100800000000000ffffff21f90401000000002c"
+    "00000000010001000002024401003b"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed(workdir, n_users):
+    os.environ["IMAGES_DIR"] = os.path.join(workdir, "images")
+    os.environ.setdefault("SPOTIFY_CLIENT_ID", "loadtest")
+    os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "loadtest")
+    from statusburo import cli, storage, utils
+
+    user_ids = [utils.create_uuid() for _ in range(n_users)]
+    users = (
+        json.dumps(
+            {
+                "user_id": user_id,
+                "user_name": f"user{i}",
+                "public": i % 2,
+                "last_success_fetch": 0,
+                "access_token": "access",
+                "refresh_token": "refresh",
+                "token_expires_at": int(time.time()) + 86400,
+            }
+        )
+        for i, user_id in enumerate(user_ids)
+    )
+    cli.import_users(os.path.join(workdir, "data", "statusburo.db"), users)
+    for user_id in user_ids:
+        storage.publish_bytes(TINY_GIF, user_id, "gif")
+    return user_ids
+
+
+async def start_fake_spotify(port):
+    async def token(request):
+        return web.json_response(
+            {
+                "access_token": "access",
+                "refresh_token": "refresh",
+                "expires_in": 3600,
+            }
+        )
+
+    async def recently_played(request):
+        return web.json_response(
+            {
+                "items": [
+                    {
+                        "played_at": time.strftime(
+                            "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()
+                        ),
+                        "track": {
+                            "name": "a really long and boring load test track",
+                            "album": {"name": "load test", "release_date": "2020"},
+                            "artists": [{"name": "the benchmarks"}],
+                        },
+                    }
+                ]
+            }
+        )
+
+    app = web.Application()
+    app.router.add_post("/api/token", token)
+    app.router.add_get("/v1/me/player/recently-played", recently_played)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def start_app(workdir, port, spotify_port, args):
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        PORT=str(port),
+        WORKERS=str(args.workers),
+        CRON_ENABLED=str(int(args.cron)),
+        WARM_START="0",
+        SPOTIFY_ACCOUNTS_URL=f"http://127.0.0.1:{spotify_port}",
+        SPOTIFY_API_URL=f"http://127.0.0.1:{spotify_port}/v1",
+        SPOTIFY_MINUTES_BETWEEN_REFRESH="0",
+        SPOTIFY_CRON_INTERVAL_SECONDS="1",
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "statusburo.app"],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.DEVNULL if not args.verbose else None,
+    )
+
+
+async def wait_until_up(base_url, timeout=30):
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            try:
+                async with session.get(base_url + "/metrics") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError("app did not start")
+
+
+def request_for(route, base_url, user_ids):
+    if route == "index":
+        return "GET", base_url + "/", {}
+    if route == "signup":
+        return (
+            "POST",
+            base_url + "/spotify/signup",
+            {"data": {"username": "bench", "public": "public"}},
+        )
+    if route == "create":
+        state = json.dumps(
+            {"uuid": f"bench{random.getrandbits(64):x}", "username": "b", "public": 0}
+        )
+        return (
+            "GET",
+            base_url + "/spotify/create",
+            {"params": {"code": "bench", "state": state}},
+        )
+    if route == "image":
+        return "GET", base_url + f"/images/{random.choice(user_ids)}.gif", {}
+
+
+async def load(route, base_url, user_ids, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(session):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            method, url, kwargs = request_for(route, base_url, user_ids)
+            started = time.perf_counter()
+            try:
+                async with session.request(
+                    method, url, allow_redirects=False, **kwargs
+                ) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarize(route, latencies, errors, elapsed)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+
+def summarize(route, latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        "route": route,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def print_table(results):
+    columns = ["route", "requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms"]
+    print("".join(f"{c:>10}" for c in columns))
+    for result in results:
+        print("".join(f"{result[c]:>10}" for c in columns))
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, "data"))
+        user_ids = seed(workdir, args.users)
+
+        spotify_port = free_port()
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        spotify = await start_fake_spotify(spotify_port)
+        process = start_app(workdir, port, spotify_port, args)
+        try:
+            await wait_until_up(base_url)
+            results = []
+            for route in args.routes:
+                results.append(
+                    await load(
+                        route, base_url, user_ids, args.concurrency, args.duration
+                    )
+                )
+        finally:
+            process.terminate()
+            process.wait()
+            await spotify.cleanup()
+
+    if args.json:
+        print(json.dumps({"cron": args.cron, "results": results}))
+    else:
+        print(f"cron {'active' if args.cron else 'idle'}, {args.users} users")
+        print_table(results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5, help="seconds per route")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=list(ROUTES))
+    parser.add_argument("--cron", action="store_true", help="run with the cron active")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="show app output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
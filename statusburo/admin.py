@@ -0,0 +1,55 @@
+import hmac
+import os
+
+from sanic import Blueprint, response
+from sanic.exceptions import NotFound, Unauthorized
+
+from statusburo import settings, profiling, tracing, leader
+
+blueprint = Blueprint("admin")
+
+
+def check_admin(request):
+    if not settings.ADMIN_TOKEN:
+        raise NotFound("Not found")
+    token = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(token, f"Bearer {settings.ADMIN_TOKEN}"):
+        raise Unauthorized("Unauthorized", scheme="Bearer")
+
+
+@blueprint.route("/admin/profile", methods=["POST"])
+async def profile(request):
+    check_admin(request)
+    target = request.args.get("target", "cron")
+    if target not in ("cron", "http"):
+        return response.text("target must be cron or http", status=400)
+    try:
+        n = int(request.args.get("n", 5))
+    except ValueError:
+        n = 0
+    if n < 1:
+        return response.text("n must be a positive integer", status=400)
+    profiling.arm(target, n)
+    return response.json(
+        {"target": target, "n": n, "pid": os.getpid(), "leader": leader.is_leader()}
+    )
+
+
+@blueprint.route("/admin/trace", methods=["POST"])
+async def trace(request):
+    check_admin(request)
+    try:
+        threshold_ms = float(request.args.get("threshold_ms", 0))
+    except ValueError:
+        threshold_ms = -1
+    # nan and inf fail this too
+    if not 0 <= threshold_ms < float("inf"):
+        return response.text("threshold_ms must be a non negative number", status=400)
+    tracing.threshold_ms = threshold_ms
+    return response.json(
+        {
+            "threshold_ms": tracing.threshold_ms,
+            "pid": os.getpid(),
+            "leader": leader.is_leader(),
+        }
+    )
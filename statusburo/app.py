@@ -5,16 +5,19 @@ logging = trustpilot_json_logging.setup_logging("INFO")
 
 import time
 import io
+import os
 import asyncio
 from collections import defaultdict, deque
 import string
 from urllib.parse import urlparse
-from statusburo import settings, spotify, db, utils
+from statusburo import settings, spotify, db, utils, leader, metrics, profiling
+from statusburo import admin, static, storage
 import aiohttp
 from sanic import Sanic
 from sanic import response
 from sanic.exceptions import (
     _sanic_exceptions,
+    NotFound,
     SanicException,
     InvalidUsage,
     ServerError,
@@ -24,25 +27,108 @@ from sanic.exceptions import (
 
 app = Sanic("statusburo")
 
-if settings.TESTING:
-    app.static("/images", "./images")
-
 
 @app.listener("before_server_start")
 async def setup_db(app, loop):
+    settings.validate()
+    static.build()
     app.db = db.SqlLite()
     await app.db.setup(settings.DB_FILE)
     app.http_session = aiohttp.ClientSession
-    spotify.start_cron(app.http_session)
+    spotify.start_wall_relay()
+    metrics.start_flush()
+    leader.start(lambda: on_elected(app), lambda: on_resigned(app))
+
+
+async def on_elected(app):
+    spotify.stop_wall_relay()
+    if settings.CRON_ENABLED:
+        spotify.start_cron(app.http_session)
+    spotify.start_storage_gc()
+    spotify.start_stats_compaction()
+    if settings.WARM_START:
+        spotify.start_warm_start(app.http_session)
+
+
+async def on_resigned(app):
+    """
+    undoes a partially failed on_elected before the leader lock is released
+    """
+    spotify.stop_cron()
+    spotify.stop_warm_start()
+    spotify.stop_storage_gc()
+    spotify.stop_stats_compaction()
+    spotify.start_wall_relay()
 
 
 @app.listener("before_server_stop")
 async def notify_server_stopping(app, loop):
-    await app.db.teardown()
     spotify.stop_cron()
+    spotify.stop_warm_start()
+    spotify.stop_storage_gc()
+    spotify.stop_stats_compaction()
+    spotify.stop_wall_relay()
+    metrics.stop_flush()
+    leader.stop()
+    await app.db.teardown()
 
 
 app.blueprint(spotify.blueprint)
+app.blueprint(admin.blueprint)
+
+
+@app.middleware("request")
+async def start_timer(request):
+    request.ctx.started = time.perf_counter()
+    if profiling.begin("http"):
+        # sanic cancels the handler task when the client disconnects and then
+        # skips the response middleware, a done callback runs either way
+        asyncio.current_task().add_done_callback(lambda _: profiling.end("http"))
+
+
+@app.middleware("response")
+async def observe_latency(request, response):
+    started = getattr(request.ctx, "started", None)
+    if started is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            route=getattr(request, "uri_template", None) or "unmatched",
+            method=request.method,
+            status=response.status,
+        )
+
+
+@app.route("/static/<name>", methods=["GET"])
+async def static_asset(request, name):
+    asset = static.assets.get(name)
+    if asset is None:
+        raise NotFound("Not found")
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": asset.etag,
+        "Vary": "Accept-Encoding",
+    }
+    if request.headers.get("If-None-Match") == asset.etag:
+        return response.raw(b"", status=304, headers=headers)
+    body, encoding = asset.negotiate(request.headers.get("Accept-Encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return response.raw(body, content_type=asset.content_type, headers=headers)
+
+
+@app.route("/images/<filename>", methods=["GET"])
+async def image(request, filename):
+    path = storage.path_for_filename(filename)
+    if path is None or not os.path.exists(path):
+        raise NotFound("Not found")
+    return await response.file(path, headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics_endpoint(request):
+    return response.text(
+        metrics.render_all(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @app.exception(utils.Redirect)
@@ -112,7 +198,11 @@ def ignore_all_unhandled_sanic_exceptions(request, exception):
 
 
 def run():
-    app.run(host="0.0.0.0", port=9002, access_log=False)
+    settings.validate()
+    metrics.reset_snapshots()
+    app.run(
+        host="0.0.0.0", port=settings.PORT, access_log=False, workers=settings.WORKERS
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import logging
+
+SUBSCRIBER_BUFFER_SIZE = 32
+KEEPALIVE_SECONDS = 15
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class Subscriber:
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = False
+
+
+class Broker:
+    """
+    In process fan-out of events to subscribers (the sse clients).
+    Every subscriber has a bounded buffer, if it fills up the subscriber
+    is dropped instead of slowing down the publisher.
+    """
+
+    def __init__(self, maxsize=SUBSCRIBER_BUFFER_SIZE):
+        self.maxsize = maxsize
+        self.subscribers = set()
+
+    def publish(self, event):
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscriber.dropped = True
+                self.subscribers.discard(subscriber)
+                # wake it up so it notices it has been dropped
+                subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+
+    async def subscribe(self, keepalive=KEEPALIVE_SECONDS):
+        """
+        yields events, or None every `keepalive` seconds without events
+        """
+        subscriber = Subscriber(self.maxsize)
+        self.subscribers.add(subscriber)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    event = None
+                if subscriber.dropped:
+                    raise SlowConsumer()
+                yield event
+        finally:
+            self.subscribers.discard(subscriber)
+
+
+singleton = Broker()
+
+
+def format_sse(event, name="message"):
+    if event is None:
+        return ": keepalive\n\n"
+    return f"event: {name}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
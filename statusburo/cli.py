@@ -0,0 +1,257 @@
+import argparse
+import json
+import sqlite3
+import subprocess
+import sys
+import time
+import logging
+
+from statusburo import settings, db, storage
+
+SPOTIFY_OAUTH_COLUMNS = [
+    "user_id",
+    "user_name",
+    "public",
+    "last_success_fetch",
+    "fetch_fails_since_last",
+    "access_token",
+    "refresh_token",
+    "token_expires_at",
+    "theme",
+    "size",
+]
+
+# only the rendering process may load these, see check_startup
+LAZY_MODULES = ["PIL", "pygifsicle", "timeago", "dateutil"]
+
+
+def connect(db_file):
+    connection = sqlite3.connect(db_file, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL;")
+    return connection
+
+
+def existing_columns(connection):
+    return {row[1] for row in connection.execute("PRAGMA table_info(spotify_oauth);")}
+
+
+def add_missing_columns(connection):
+    columns = existing_columns(connection)
+    for column, column_type in db.SPOTIFY_OAUTH_ADDED_COLUMNS.items():
+        if column not in columns:
+            connection.execute(
+                f"ALTER TABLE spotify_oauth ADD COLUMN {column} {column_type};"
+            )
+
+
+def backup(db_file, target_file, pages=1024, sleep=0.005):
+    """
+    Snapshot a live db using the sqlite online backup api.
+    Copies `pages` pages per step and yields the lock in between,
+    so the writer (the cron) is never blocked for long.
+    """
+
+    def progress(status, remaining, total):
+        logging.debug(
+            {"message": "backup progress", "remaining": remaining, "total": total}
+        )
+
+    source = connect(db_file)
+    target = sqlite3.connect(target_file)
+    try:
+        with target:
+            source.backup(target, pages=pages, progress=progress, sleep=sleep)
+    finally:
+        target.close()
+        source.close()
+
+
+def export_users(db_file, out):
+    connection = connect(db_file)
+    n = 0
+    try:
+        # read only, columns a not yet migrated db lacks are exported as null
+        columns = existing_columns(connection)
+        select = [
+            column if column in columns else f"NULL AS {column}"
+            for column in SPOTIFY_OAUTH_COLUMNS
+        ]
+        cursor = connection.execute(f"SELECT {', '.join(select)} FROM spotify_oauth;")
+        cursor.arraysize = 1000
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            out.write(
+                "".join(
+                    json.dumps(dict(zip(SPOTIFY_OAUTH_COLUMNS, row))) + "\n"
+                    for row in rows
+                )
+            )
+            n += len(rows)
+    finally:
+        connection.close()
+    return n
+
+
+def import_users(db_file, lines, batch_size=10000):
+    """
+    Bulk insert ndjson users, replacing existing rows with the same user_id.
+    Every batch is written in one transaction.
+    """
+    connection = connect(db_file)
+    connection.execute(db.SPOTIFY_OAUTH_SCHEMA)
+    add_missing_columns(connection)
+    query = f"""
+        INSERT OR REPLACE INTO spotify_oauth ({', '.join(SPOTIFY_OAUTH_COLUMNS)})
+        VALUES ({', '.join('?' for _ in SPOTIFY_OAUTH_COLUMNS)});
+    """
+    n = 0
+
+    def rows():
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                user = json.loads(line)
+                user.setdefault("public", 0)
+                user.setdefault("last_success_fetch", 0)
+                user.setdefault("fetch_fails_since_last", 0)
+                user.setdefault("user_name", None)
+                user.setdefault("theme", None)
+                user.setdefault("size", None)
+                row = [user[key] for key in SPOTIFY_OAUTH_COLUMNS]
+            except (ValueError, KeyError, AttributeError) as e:
+                raise ValueError(f"invalid user on line {line_number}: {e!r}") from e
+            yield row
+
+    try:
+        batch = []
+        for row in rows():
+            batch.append(row)
+            if len(batch) >= batch_size:
+                with connection:
+                    connection.executemany(query, batch)
+                n += len(batch)
+                batch = []
+        if batch:
+            with connection:
+                connection.executemany(query, batch)
+            n += len(batch)
+    finally:
+        connection.close()
+    return n
+
+
+def check_startup(module="statusburo.app", budget_ms=None, runs=5):
+    """
+    Cold imports `module` in fresh interpreters with `python -X importtime`.
+    Reports the fastest run and the lazy render modules it loaded anyway.
+    """
+    code = (
+        f"import sys, json, {module}; "
+        f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    )
+    best_us = None
+    loaded = []
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # last importtime line is the module itself:
+        # "import time: self | cumulative | name"
+        timings = [
+            l for l in process.stderr.splitlines() if l.startswith("import time:")
+        ]
+        cumulative_us = int(timings[-1].split("|")[1])
+        best_us = cumulative_us if best_us is None else min(best_us, cumulative_us)
+        loaded = json.loads(process.stdout.splitlines()[-1])
+    result = {
+        "module": module,
+        "import_ms": round(best_us / 1000, 1),
+        "loaded": loaded,
+    }
+    result["ok"] = not loaded and (budget_ms is None or best_us / 1000 <= budget_ms)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="statusburo")
+    parser.add_argument("--db", default=settings.DB_FILE, help="sqlite db file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backup_parser = commands.add_parser("backup", help="online snapshot of the db")
+    backup_parser.add_argument("target", help="snapshot file to write")
+
+    export_parser = commands.add_parser("export", help="export users as ndjson")
+    export_parser.add_argument("file", nargs="?", default="-", help="default stdout")
+
+    import_parser = commands.add_parser("import", help="import users from ndjson")
+    import_parser.add_argument("file", nargs="?", default="-", help="default stdin")
+    import_parser.add_argument("--batch-size", type=int, default=10000)
+
+    commands.add_parser(
+        "migrate-images", help="move flat images into the sharded layout"
+    )
+
+    check_parser = commands.add_parser(
+        "check-startup", help="fail when importing the app is over budget"
+    )
+    check_parser.add_argument("--module", default="statusburo.app")
+    check_parser.add_argument(
+        "--budget-ms", type=float, default=settings.STARTUP_BUDGET_MS
+    )
+    check_parser.add_argument("--runs", type=int, default=5)
+
+    args = parser.parse_args(argv)
+    started = time.time()
+
+    if args.command == "backup":
+        backup(args.db, args.target)
+        n = None
+    elif args.command == "export":
+        if args.file == "-":
+            n = export_users(args.db, sys.stdout)
+        else:
+            with open(args.file, "w") as out:
+                n = export_users(args.db, out)
+    elif args.command == "import":
+        try:
+            if args.file == "-":
+                n = import_users(args.db, sys.stdin, args.batch_size)
+            else:
+                with open(args.file) as lines:
+                    n = import_users(args.db, lines, args.batch_size)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.command == "migrate-images":
+        n = storage.migrate_flat_layout()
+    elif args.command == "check-startup":
+        result = check_startup(args.module, args.budget_ms, args.runs)
+        print(json.dumps(result))
+        if not result["ok"]:
+            sys.exit(1)
+        n = None
+
+    print(
+        json.dumps(
+            {
+                "command": args.command,
+                "rows": n,
+                "seconds": round(time.time() - started, 3),
+            }
+        ),
+        file=sys.stderr,
+    )
+
+
+def run():
+    main()
+
+
+if __name__ == "__main__":
+    run()
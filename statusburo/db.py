@@ -4,12 +4,13 @@ import asyncio
 from contextlib import asynccontextmanager
 import time
 import os
+import sqlite3
 import aiosqlite
 from datetime import date, datetime, timedelta
 import logging
 from collections import deque
 
-from statusburo import settings
+from statusburo import settings, metrics
 
 
 def get_current_date_string():
@@ -25,28 +26,86 @@ START_TIMESTAMP = get_current_date_string()
 
 singleton = None
 
+SPOTIFY_ROW_KEYS = [
+    "user_id",
+    "user_name",
+    "public",
+    "last_success_fetch",
+    "fetch_fails_since_last",
+    "access_token",
+    "refresh_token",
+    "token_expires_at",
+    "theme",
+    "size",
+]
+
+# columns added after the first release, ALTERed into older dbs by setup
+SPOTIFY_OAUTH_ADDED_COLUMNS = {"theme": "TEXT", "size": "TEXT"}
+
+SPOTIFY_OAUTH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS spotify_oauth (
+    user_id TEXT NOT NULL PRIMARY KEY,
+    user_name TEXT,
+    public INTEGER default 0,
+    last_success_fetch INTEGER default 0,
+    fetch_fails_since_last INTEGER default 0,
+    access_token TEXT NOT NULL,
+    refresh_token TEXT NOT NULL,
+    token_expires_at INTEGER NOT NULL,
+    theme TEXT,
+    size TEXT
+);
+"""
+
+# rolling play counts per user, period ("day"/"week"), bucket, kind
+# ("artist"/"track") and name, updated on every play the cron records
+SPOTIFY_PLAY_COUNTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS spotify_play_counts (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    plays INTEGER NOT NULL default 0,
+    PRIMARY KEY (user_id, period, bucket, kind, name)
+) WITHOUT ROWID;
+"""
+
+
+def day_bucket(played_at):
+    return played_at.strftime("%Y-%m-%d")
+
+
+def week_bucket(played_at):
+    year, week, _ = played_at.isocalendar()
+    return f"{year}-W{week:02d}"
+
 
 class SqlLite:
     def __init__(self):
-        self.TOPICS_REGISTRY = defaultdict(dict)
-        self.PUB_SUB_LOCK = Lock()
         self.db = None
+        self.write_lock = None
 
     async def setup(self, sqlite_filename):
-        self.db = await aiosqlite.connect(sqlite_filename)
+        # several workers share the db file, wait for each others write locks
+        self.db = await aiosqlite.connect(sqlite_filename, timeout=30)
+        self.write_lock = Lock()
         try:
+            # WAL lets the backup cli snapshot the db without blocking our writes
+            await self.db.execute("PRAGMA journal_mode=WAL;")
+            await self.db.execute(SPOTIFY_OAUTH_SCHEMA)
+            await self.add_missing_columns()
+            await self.db.execute(SPOTIFY_PLAY_COUNTS_SCHEMA)
             await self.db.execute(
                 """
-            CREATE TABLE IF NOT EXISTS spotify_oauth (
-                user_id TEXT NOT NULL PRIMARY KEY,
-                user_name TEXT,
-                public INTEGER default 0,
-                last_success_fetch INTEGER default 0,
-                fetch_fails_since_last INTEGER default 0,
-                access_token TEXT NOT NULL,
-                refresh_token TEXT NOT NULL,
-                token_expires_at INTEGER NOT NULL
-            );
+            CREATE INDEX IF NOT EXISTS spotify_play_counts_top
+                ON spotify_play_counts (user_id, period, bucket, kind, plays);
+            """
+            )
+            await self.db.execute(
+                """
+            CREATE INDEX IF NOT EXISTS spotify_oauth_public_fetch
+                ON spotify_oauth (public, last_success_fetch);
             """
             )
             await self.db.commit()
@@ -56,21 +115,147 @@ class SqlLite:
         global singleton
         singleton = self
 
+    async def add_missing_columns(self):
+        async with self.db.execute("PRAGMA table_info(spotify_oauth);") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        for column, column_type in SPOTIFY_OAUTH_ADDED_COLUMNS.items():
+            if column in columns:
+                continue
+            try:
+                await self.db.execute(
+                    f"ALTER TABLE spotify_oauth ADD COLUMN {column} {column_type};"
+                )
+            except sqlite3.OperationalError as e:
+                # another worker added it in the meantime
+                if "duplicate column" not in str(e):
+                    raise
+
     async def teardown(self):
         await self.db.close()
-    
+
+    @asynccontextmanager
+    async def query(self, name, sql, parameters=None):
+        with metrics.DB_QUERY_SECONDS.time(query=name):
+            async with self.db.execute(sql, parameters) as cursor:
+                yield cursor
+
+    async def execute(self, name, sql, parameters=None):
+        with metrics.DB_QUERY_SECONDS.time(query=name):
+            await self.db.execute(sql, parameters)
+
+    @asynccontextmanager
+    async def transaction(self, name):
+        """
+        Every write goes through here. The connection is shared by concurrent
+        coroutines, without the lock their statements would end up in each
+        others commit or rollback.
+        """
+        async with self.write_lock:
+            try:
+                yield
+                with metrics.DB_COMMIT_SECONDS.time(query=name):
+                    await self.db.commit()
+            except:
+                # a failed commit too, or the next writer would commit it
+                await self.db.rollback()
+                raise
+
     async def spotify_delete(self,user_id):
-        await self.db.execute(
+        async with self.transaction("spotify_delete"):
+            await self.execute(
+                "spotify_delete",
+                """
+                delete from spotify_oauth
+                where user_id = ?;
+                """,
+                [user_id],
+            )
+            await self.execute(
+                "spotify_delete",
                 """
-            delete from spotify_oauth
-            where user_id = ?;
+                delete from spotify_play_counts
+                where user_id = ?;
+                """,
+                [user_id],
+            )
+
+    async def spotify_record_fetch(self, user_id, plays, played_at, **auth):
+        """
+        Counts the fetched plays and moves last_success_fetch past them in
+        one transaction, so a failed round never counts the same plays twice.
+        """
+        async with self.transaction("spotify_record_fetch"):
+            await self.insert_play_counts(user_id, plays)
+            await self.update_fetch(user_id, played_at=played_at, **auth)
+
+    async def insert_play_counts(self, user_id, plays):
+        """
+        plays are dicts with played_at, artist_name and track_name
+        """
+        rows = []
+        for play in plays:
+            played_at = play["played_at"]
+            track = f"{play['artist_name']} - {play['track_name']}"
+            for period, bucket in (
+                ("day", day_bucket(played_at)),
+                ("week", week_bucket(played_at)),
+            ):
+                rows.append([user_id, period, bucket, "artist", play["artist_name"]])
+                rows.append([user_id, period, bucket, "track", track])
+        with metrics.DB_QUERY_SECONDS.time(query="insert_play_counts"):
+            await self.db.executemany(
+                """
+                insert into spotify_play_counts(
+                    user_id, period, bucket, kind, name, plays
+                )
+                values(?, ?, ?, ?, ?, 1)
+                on conflict(user_id, period, bucket, kind, name)
+                do update set plays = plays + 1;
             """,
-            [user_id]
+                rows,
+            )
+
+    async def spotify_get_top_plays(self, user_id, period, bucket, kind, n=10):
+        async with self.query(
+            "spotify_get_top_plays",
+            """
+            SELECT name, plays
+            FROM spotify_play_counts
+            where user_id = ? and period = ? and bucket = ? and kind = ?
+            order by plays desc
+            limit ?;
+        """,
+            [user_id, period, bucket, kind, n],
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def spotify_compact_play_counts(self, day_retention, week_retention):
+        """
+        Drops day buckets older than `day_retention` days and week buckets
+        older than `week_retention` weeks, the week buckets keep the totals.
+        """
+        now = datetime.utcnow()
+        async with self.transaction("spotify_compact_play_counts"):
+            await self.execute(
+                "spotify_compact_play_counts",
+                """
+                delete from spotify_play_counts
+                where period = 'day' and bucket < ?;
+                """,
+                [day_bucket(now - timedelta(days=day_retention))],
+            )
+            await self.execute(
+                "spotify_compact_play_counts",
+                """
+                delete from spotify_play_counts
+                where period = 'week' and bucket < ?;
+                """,
+                [week_bucket(now - timedelta(weeks=week_retention))],
             )
-        await self.db.commit()
 
     async def spotify_get_latest_public(self, n=10):
-        async with self.db.execute(
+        async with self.query(
+            "spotify_get_latest_public",
             """
             SELECT 
                 user_id
@@ -85,6 +270,34 @@ class SqlLite:
             rows = await cursor.fetchall()
             return [r[0] for r in rows]
 
+    async def spotify_get_size(self, user_id):
+        async with self.query(
+            "spotify_get_size",
+            """
+            SELECT size FROM spotify_oauth where user_id = ?;
+        """,
+            [user_id],
+        ) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+    async def spotify_get_latest_public_fetches(self, n=10):
+        async with self.query(
+            "spotify_get_latest_public_fetches",
+            """
+            SELECT 
+                user_id,
+                last_success_fetch
+            FROM spotify_oauth 
+            where public = 1
+            order by 
+                last_success_fetch desc
+            limit ?;
+        """,
+            [n],
+        ) as cursor:
+            return await cursor.fetchall()
+
     async def spotify_get(self, n=10):
         utc_before = int(
             (
@@ -93,16 +306,20 @@ class SqlLite:
             ).timestamp()
             * 1000.0
         )
-        async with self.db.execute(
+        async with self.query(
+            "spotify_get",
             """
             SELECT 
                 user_id,
                 user_name,
+                public,
                 last_success_fetch, 
                 fetch_fails_since_last, 
                 access_token,
                 refresh_token,
-                token_expires_at
+                token_expires_at,
+                theme,
+                size
             FROM spotify_oauth 
             where 
                 last_success_fetch < ?
@@ -113,18 +330,51 @@ class SqlLite:
             [utc_before, n],
         ) as cursor:
             rows = await cursor.fetchall()
-            keys = [
-                "user_id",
-                "user_name",
-                "last_success_fetch",
-                "fetch_fails_since_last",
-                "access_token",
-                "refresh_token",
-                "token_expires_at",
-            ]
-            return [dict(zip(keys, values)) for values in rows]
-
-    async def spotify_update(
+            return [dict(zip(SPOTIFY_ROW_KEYS, values)) for values in rows]
+
+    async def spotify_get_all_user_ids(self):
+        async with self.query(
+            "spotify_get_all_user_ids",
+            """
+            SELECT user_id FROM spotify_oauth;
+        """,
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return [r[0] for r in rows]
+
+    async def spotify_get_all(self):
+        async with self.query(
+            "spotify_get_all",
+            f"""
+            SELECT {", ".join(SPOTIFY_ROW_KEYS)}
+            FROM spotify_oauth;
+        """,
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return [dict(zip(SPOTIFY_ROW_KEYS, values)) for values in rows]
+
+    async def spotify_update(self, user_id, **kwargs):
+        async with self.transaction("spotify_update"):
+            await self.update_fetch(user_id, **kwargs)
+
+    async def spotify_update_tokens(
+        self, user_id, access_token, refresh_token, token_expires_at
+    ):
+        async with self.transaction("spotify_update_tokens"):
+            await self.execute(
+                "spotify_update_tokens",
+                """
+                update spotify_oauth
+                SET
+                    access_token=?,
+                    refresh_token=?,
+                    token_expires_at=?
+                where user_id = ?
+            """,
+                [access_token, refresh_token, token_expires_at, user_id],
+            )
+
+    async def update_fetch(
         self,
         user_id,
         access_token,
@@ -135,7 +385,8 @@ class SqlLite:
     ):
         played_at = played_at or datetime.utcnow()
         played_at_epoch_ms = int(played_at.timestamp() * 1000.0)
-        await self.db.execute(
+        await self.execute(
+            "update_fetch",
             """
             update spotify_oauth
             SET 
@@ -153,7 +404,6 @@ class SqlLite:
                 user_id,
             ],
         )
-        await self.db.commit()
 
     async def spotify_create(
         self,
@@ -163,123 +413,36 @@ class SqlLite:
         refresh_token,
         token_expires_at,
         user_name=None,
+        theme=None,
+        size=None,
     ):
         utc_now = int((datetime.utcnow() - timedelta(hours=24)).timestamp() * 1000.0)
-        await self.db.execute(
-            """
-            insert into spotify_oauth(
-                last_success_fetch,
-                user_id, 
-                user_name,
-                public, 
-                access_token,
-                refresh_token,
-                token_expires_at
+        async with self.transaction("spotify_create"):
+            await self.execute(
+                "spotify_create",
+                """
+                insert into spotify_oauth(
+                    last_success_fetch,
+                    user_id, 
+                    user_name,
+                    public, 
+                    access_token,
+                    refresh_token,
+                    token_expires_at,
+                    theme,
+                    size
+                )
+                values(?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+                [
+                    utc_now,
+                    user_id,
+                    user_name,
+                    int(public),
+                    access_token,
+                    refresh_token,
+                    token_expires_at,
+                    theme,
+                    size,
+                ],
             )
-            values(?, ?, ?, ?, ?, ?, ?)
-        """,
-            [
-                utc_now,
-                user_id,
-                user_name,
-                int(public),
-                access_token,
-                refresh_token,
-                token_expires_at,
-            ],
-        )
-        await self.db.commit()
-
-    # async def publish(self, topic, author, message):
-    #     timestamp = get_current_datetime_string()
-    #     await self.db.execute(
-    #         f"INSERT INTO messages values(?,?,?,?);",
-    #         [topic, timestamp, message, author],
-    #     )
-    #     await self.db.commit()
-
-    # async def subscribe(self, topic):
-    #     current_date = get_current_datetime_string()
-    #     last_message = time.time()
-    #     try:
-    #         yield 0, None
-    #         messages = deque()
-    #         await self.db.execute(
-    #             """
-    #             INSERT INTO analytics_subscribers (topic, start)
-    #                 VALUES(?, ?);
-    #         """,
-    #             [
-    #                 topic,
-    #                 current_date,
-    #             ],
-    #         )
-
-    #         await self.db.commit()
-
-    #         timestamp = START_TIMESTAMP
-    #         async with self.db.execute(
-    #             """
-    #             SELECT author, message, timestamp
-    #             FROM messages
-    #             where topic = ?
-    #             order by timestamp desc limit 10;
-    #         """,
-    #             [topic],
-    #         ) as cursor:
-    #             async for row in cursor:
-    #                 messages.append(row[:2])
-    #                 timestamp = row[2]
-    #         got_message_last_time = True
-    #         while True:
-    #             async with self.db.execute(
-    #                 """
-    #                 select count(*)
-    #                 from analytics_subscribers
-    #                 where topic = ? and end is null;
-    #             """,
-    #                 [topic],
-    #             ) as cursor:
-    #                 row = await cursor.fetchone()
-    #                 visitors = int(row[0])
-
-    #             got_message = False
-    #             async with self.db.execute(
-    #                 """
-    #                 SELECT author, message, timestamp
-    #                 FROM messages
-    #                 where topic = ?
-    #                     and datetime(timestamp) > datetime(?)
-    #                 order by timestamp asc;
-    #             """,
-    #                 [topic, timestamp],
-    #             ) as cursor:
-    #                 async for row in cursor:
-    #                     messages.append(row[:2])
-    #                     timestamp = row[2]
-    #                     got_message = True
-    #             while True:
-    #                 try:
-    #                     yield visitors, messages.pop()
-    #                     last_message = time.time()
-    #                 except IndexError:
-    #                     break
-
-    #             if got_message != got_message_last_time or time.time() >  last_message+10:
-    #                 yield visitors, None
-    #                 yield visitors, None
-    #             got_message_last_time = got_message
-    #             await asyncio.sleep(1)
-    #     except:
-    #         logging.exception("err")
-    #     finally:
-    #         await self.db.execute(
-    #             """
-    #             UPDATE analytics_subscribers
-    #             SET end = ?
-    #             where topic = ? and start = ?
-    #         """,
-    #             [get_current_datetime_string(), topic, current_date],
-    #         )
-
-    #         await self.db.commit()
@@ -0,0 +1,74 @@
+import asyncio
+import fcntl
+import logging
+import os
+
+from statusburo import settings
+
+lock_file = None
+campaign_task = None
+
+
+def try_acquire(path):
+    """
+    Non blocking exclusive flock on `path`.
+    The kernel releases it when the holding process dies,
+    which is what makes the failover automatic.
+    """
+    global lock_file
+    f = open(path, "a+")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    lock_file = f
+    return True
+
+
+def is_leader():
+    return lock_file is not None
+
+
+async def campaign(on_elected, on_resigned, retry_seconds):
+    while True:
+        while not try_acquire(settings.LEADER_LOCK_FILE):
+            await asyncio.sleep(retry_seconds)
+        logging.info({"message": "elected cron leader", "pid": os.getpid()})
+        try:
+            await on_elected()
+            return
+        except:
+            # step down so another worker (or our next attempt) can lead,
+            # holding the lock here would leave the cron running nowhere
+            logging.exception("Error taking over as cron leader, stepping down")
+            if on_resigned is not None:
+                await on_resigned()
+            release()
+            await asyncio.sleep(retry_seconds)
+
+
+def start(on_elected, on_resigned=None, retry_seconds=None):
+    global campaign_task
+    retry_seconds = retry_seconds or settings.LEADER_RETRY_SECONDS
+    campaign_task = asyncio.get_event_loop().create_task(
+        campaign(on_elected, on_resigned, retry_seconds)
+    )
+
+
+def stop():
+    if campaign_task:
+        campaign_task.cancel()
+    release()
+
+
+def release():
+    global lock_file
+    if lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+        lock_file = None
@@ -0,0 +1,287 @@
+"""
+Minimal prometheus text format metrics.
+Values live in plain dicts keyed by label values, so recording is a dict
+lookup and an addition. With several workers every process snapshots its
+values to METRICS_DIR/{pid}.json and /metrics merges the snapshots of all
+workers: counters and histograms are summed, gauges come from the most
+recent snapshot that has them.
+"""
+import os
+import glob
+import json
+import time
+import shutil
+import asyncio
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from statusburo import settings
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 10, 25, 50, 100, 200, 400, 800)
+BYTES_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 5e6)
+STALENESS_BUCKETS = (60, 300, 600, 1800, 3600, 6 * 3600, 86400, 7 * 86400)
+
+registry = []
+
+
+def format_labels(labelnames, key, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def merge(self, merged, key, value):
+        merged[key] = merged.get(key, 0) + value
+
+    def render(self, values=None):
+        values = self.values if values is None else values
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for key, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def merge(self, merged, key, value):
+        # snapshots are merged oldest first, the last one wins
+        merged[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        values = self.values.get(key)
+        if values is None:
+            # bucket counts, then +Inf, sum
+            values = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, merged, key, value):
+        values = merged.get(key)
+        if values is None:
+            merged[key] = list(value)
+        else:
+            merged[key] = [a + b for a, b in zip(values, value)]
+
+    def render(self, values=None):
+        values = self.values if values is None else values
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for key, values in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {values[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_path(pid=None):
+    return os.path.join(settings.METRICS_DIR, f"{pid or os.getpid()}.json")
+
+
+def dump():
+    """
+    Atomically writes this process' values to its snapshot file.
+    """
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    path = snapshot_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(
+            {
+                metric.name: [
+                    [list(key), value] for key, value in metric.values.items()
+                ]
+                for metric in registry
+            },
+            f,
+        )
+    os.replace(tmp, path)
+
+
+def render_all():
+    """
+    Prometheus text of all workers, merged from their snapshot files.
+    Snapshots of workers that exited are kept so counters never go back.
+    """
+    dump()
+    snapshots = []
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                snapshots.append((os.path.getmtime(path), json.load(f)))
+        except (OSError, ValueError):
+            logging.exception(f"Error reading metrics snapshot {path}")
+    snapshots.sort(key=lambda snapshot: snapshot[0])
+
+    lines = []
+    for metric in registry:
+        merged = {}
+        for _, snapshot in snapshots:
+            for key, value in snapshot.get(metric.name, []):
+                metric.merge(merged, tuple(key), value)
+        lines.extend(metric.render(merged))
+    return "\n".join(lines) + "\n"
+
+
+def reset_snapshots():
+    """
+    Called once by the parent process before the workers start, snapshots
+    of a previous run would otherwise be summed into this one.
+    """
+    shutil.rmtree(settings.METRICS_DIR, ignore_errors=True)
+
+
+flush_task = None
+
+
+async def flush(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            dump()
+        except:
+            logging.exception("Error writing metrics snapshot")
+
+
+def start_flush():
+    global flush_task
+    flush_task = asyncio.get_event_loop().create_task(
+        flush(settings.METRICS_FLUSH_SECONDS)
+    )
+
+
+def stop_flush():
+    if flush_task:
+        flush_task.cancel()
+    try:
+        dump()
+    except:
+        logging.exception("Error writing metrics snapshot")
+
+
+SPOTIFY_REQUEST_SECONDS = Histogram(
+    "statusburo_spotify_request_seconds",
+    "Spotify api call latency",
+    ["endpoint", "status"],
+)
+SPOTIFY_RATE_LIMITED = Counter(
+    "statusburo_spotify_rate_limited_total",
+    "Spotify 429 responses",
+    ["endpoint"],
+)
+SPOTIFY_TOKEN_REFRESHES = Counter(
+    "statusburo_spotify_token_refreshes_total",
+    "Spotify access token refreshes",
+    ["status"],
+)
+RENDER_SECONDS = Histogram(
+    "statusburo_render_seconds", "Gif render duration", buckets=SLOW_BUCKETS
+)
+RENDER_FRAMES = Histogram(
+    "statusburo_render_frames", "Frames per rendered gif", buckets=COUNT_BUCKETS
+)
+RENDER_BYTES = Histogram(
+    "statusburo_render_bytes", "Size of rendered gifs", buckets=BYTES_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram(
+    "statusburo_db_query_seconds", "SqlLite query latency", ["query"]
+)
+DB_COMMIT_SECONDS = Histogram(
+    "statusburo_db_commit_seconds", "SqlLite commit latency", ["query"]
+)
+CRON_ROUND_SECONDS = Histogram(
+    "statusburo_cron_round_seconds", "Spotify cron round duration", buckets=SLOW_BUCKETS
+)
+USER_STALENESS_SECONDS = Histogram(
+    "statusburo_user_staleness_seconds",
+    "Age of a users last fetched play when the cron polls it",
+    buckets=STALENESS_BUCKETS,
+)
+WARM_START_REMAINING = Gauge(
+    "statusburo_warm_start_remaining", "Users left to rebuild in the warm start"
+)
+WARM_START_REBUILT = Counter(
+    "statusburo_warm_start_rebuilt_total",
+    "Users processed by the warm start",
+    ["outcome"],
+)
+STORAGE_BYTES = Gauge("statusburo_storage_bytes", "Bytes used by rendered images")
+STORAGE_FILES = Gauge("statusburo_storage_files", "Number of rendered images")
+STORAGE_QUOTA_BYTES = Gauge(
+    "statusburo_storage_quota_bytes", "Disk quota for rendered images, 0 is none"
+)
+STORAGE_REMOVED = Counter(
+    "statusburo_storage_removed_total",
+    "Images removed by the storage gc",
+    ["reason"],
+)
+RENDER_CACHE_BYTES = Gauge(
+    "statusburo_render_cache_bytes", "Bytes held by the render asset cache"
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "statusburo_http_request_seconds",
+    "Http handler latency",
+    ["route", "method", "status"],
+)
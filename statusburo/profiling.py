@@ -0,0 +1,90 @@
+"""
+On demand sampling profiler.
+`arm("cron", 5)` profiles the next 5 cron rounds, `arm("http", 100)` the next
+100 requests. While armed iterations run, a thread samples the stacks of all
+threads (so the render executor is included) and when the last one ends the
+samples are written as collapsed stacks, ready for flamegraph.pl or speedscope.
+Unarmed, begin/end is a single dict lookup.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from statusburo import settings
+
+armed = {}
+active = Counter()
+sampler = None
+
+
+class Sampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name="statusburo-profiler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+def arm(target, n):
+    armed[target] = n
+
+
+def begin(target):
+    global sampler
+    if not armed.get(target):
+        return False
+    armed[target] -= 1
+    active[target] += 1
+    if sampler is None:
+        sampler = Sampler(settings.PROFILE_INTERVAL_MS / 1000.0)
+        sampler.start()
+    return True
+
+
+def end(target):
+    global sampler
+    active[target] -= 1
+    if armed.get(target) or sum(active.values()) or sampler is None:
+        return
+    stacks = sampler.stop()
+    sampler = None
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    filename = os.path.join(
+        settings.PROFILE_DIR, f"{target}-{os.getpid()}-{int(time.time())}.collapsed"
+    )
+    with open(filename, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    logging.info({"message": "wrote profile", "file": filename})
+
+
+@contextmanager
+def profile(target):
+    profiled = begin(target)
+    try:
+        yield
+    finally:
+        if profiled:
+            end(target)
@@ -1,4 +1,5 @@
 import os
+import io
 
 from PIL import Image, ImageFont, ImageDraw
 from pygifsicle import gifsicle
@@ -7,63 +8,152 @@ import timeago
 import tempfile
 import logging
 import asyncio
-from shutil import copyfile
-
-
-CACHE = {}
-
-background_color = (26, 26, 26)
-artist_album_color = (0, 219, 212)
-track_color = (3, 252, 119)
-time_color = (255, 110, 217)
+import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple
+from xml.sax.saxutils import escape
+
+from statusburo import settings, metrics, tracing, storage
+from statusburo.themes import THEMES, SIZES
+
+
+class AssetCache:
+    """
+    LRU cache bounded by the bytes of its values, shared by the render threads
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            self.items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, n_bytes):
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, n_bytes)
+            self.bytes += n_bytes
+            while self.bytes > self.max_bytes and len(self.items) > 1:
+                _, (_, evicted_bytes) = self.items.popitem(last=False)
+                self.bytes -= evicted_bytes
+            metrics.RENDER_CACHE_BYTES.set(self.bytes)
+
+
+CACHE = AssetCache(settings.RENDER_CACHE_BYTES)
+
+background_color, artist_album_color, track_color, time_color = THEMES["default"]
 right_margin = 5
 left_margin = 5
 top_bottom_margin = 5
 
+# palette mode draws with a fixed palette: transparent black, the background
+# and AA_LEVELS shades from the background to each text color
+AA_LEVELS = 4
+TRANSPARENT_INDEX = 0
+BACKGROUND_INDEX = 1
+
+
+def blend(a, b, alpha):
+    return tuple(int(round(x + (y - x) * alpha)) for x, y in zip(a, b))
+
+
+@lru_cache(maxsize=None)
+def build_palette(theme):
+    colors = [(0, 0, 0), theme.background_color]
+    shade_indices = {}
+    for role in ("artist_album_color", "track_color", "time_color"):
+        shade_indices[role] = len(colors)
+        for level in range(1, AA_LEVELS + 1):
+            colors.append(
+                blend(theme.background_color, getattr(theme, role), level / AA_LEVELS)
+            )
+    return [channel for color in colors for channel in color], shade_indices
+
 
-def get_background_image(width, height):
-    key = f"{width}_{height}"
+def get_background_image(
+    width, height, mode="RGB", theme=THEMES["default"], margin=left_margin
+):
+    key = (mode, width, height, theme, margin)
     background_image = CACHE.get(key)
     if not background_image:
-        background_image = Image.new("RGB", (width, height), (0, 0, 0))
+        if mode == "P":
+            background_image = Image.new("P", (width, height), TRANSPARENT_INDEX)
+            background_image.putpalette(build_palette(theme)[0])
+            fill = BACKGROUND_INDEX
+        else:
+            background_image = Image.new("RGB", (width, height), (0, 0, 0))
+            fill = theme.background_color
         draw = ImageDraw.Draw(background_image)
+        draw.ellipse(((0, 0), (margin * 3, margin * 3)), fill=fill)
         draw.ellipse(
-            ((0, 0), (left_margin * 3, left_margin * 3)), fill=background_color
-        )
-        draw.ellipse(
-            ((0, height - left_margin * 3), (left_margin * 3, height)),
-            fill=background_color,
+            ((0, height - margin * 3), (margin * 3, height)),
+            fill=fill,
         )
         draw.ellipse(
-            ((width - left_margin * 3, 0), (width, left_margin * 3)),
-            fill=background_color,
+            ((width - margin * 3, 0), (width, margin * 3)),
+            fill=fill,
         )
         draw.ellipse(
-            ((width - left_margin * 3, height - left_margin * 3), (width, height)),
-            fill=background_color,
+            ((width - margin * 3, height - margin * 3), (width, height)),
+            fill=fill,
         )
-        draw.rectangle(
-            [(0, left_margin), (width, height - left_margin)], fill=background_color
-        )
-        draw.rectangle(
-            [(left_margin, 0), (width - left_margin, height)], fill=background_color
-        )
-        CACHE[key] = background_image
+        draw.rectangle([(0, margin), (width, height - margin)], fill=fill)
+        draw.rectangle([(margin, 0), (width - margin, height)], fill=fill)
+        CACHE.put(key, background_image, width * height * len(mode))
     return background_image.copy()
 
 
-def render(
-    user_id,
+@lru_cache(maxsize=2 * len(SIZES))
+def get_font(font_size):
+    current_dir = os.path.dirname(__file__)
+    return ImageFont.truetype(f"{current_dir}/COMIC.TTF", font_size)
+
+
+class Layout(NamedTuple):
+    width: int
+    height: int
+    font_size: int
+    x_step: int
+    x_margin: int
+    max_width: int
+    time_string: str
+    artist_name: str
+    album_name: str
+    track_name: str
+    time_string_width: int
+    artist_name_width: int
+    album_name_width: int
+    track_name_width: int
+    scroll: bool
+    scroll_time: bool
+    scroll_artist: bool
+    scroll_album: bool
+    scroll_track: bool
+    margin: int = left_margin
+
+
+def plan_layout(
     user_name,
     artist_name,
     track_name,
     album_name,
     release_date,
     played_at,
-    *args,
-    **kwargs,
 ):
-    images = []
+    """
+    Text measurement and scroll planning shared by the gif and svg renderers
+    """
     width = 250
 
     x_step = 7
@@ -80,9 +170,7 @@ def render(
 
     album_name += f" ({release_date[:4]})"
 
-    current_dir = os.path.dirname(__file__)
-
-    font = ImageFont.truetype(f"{current_dir}/COMIC.TTF", font_size)
+    font = get_font(font_size)
 
     time_string_width = font.getsize(time_string)[0]
     artist_name_width = font.getsize(artist_name)[0]
@@ -101,6 +189,235 @@ def render(
         + 10
     )
 
+    excess_width = (max_width + x_margin) - (width - right_margin)
+    return Layout(
+        width=width,
+        height=height,
+        font_size=font_size,
+        x_step=x_step,
+        x_margin=x_margin,
+        max_width=max_width,
+        time_string=time_string,
+        artist_name=artist_name,
+        album_name=album_name,
+        track_name=track_name,
+        time_string_width=time_string_width,
+        artist_name_width=artist_name_width,
+        album_name_width=album_name_width,
+        track_name_width=track_name_width,
+        scroll=excess_width > 0,
+        scroll_time=(time_string_width) > (width - right_margin),
+        scroll_artist=(artist_name_width + x_margin) > (width - right_margin),
+        scroll_album=(album_name_width + x_margin) > (width - right_margin),
+        scroll_track=(track_name_width + x_margin) > (width - right_margin),
+    )
+
+
+def scale_layout(layout, scale):
+    """
+    Layout of a size variant, derived from the 1x layout without measuring the
+    texts again. Scroll decisions don't change since everything scales alike.
+    """
+    if scale == 1:
+        return layout
+
+    def px(value):
+        return int(round(value * scale))
+
+    return layout._replace(
+        width=px(layout.width),
+        height=px(layout.height),
+        font_size=px(layout.font_size),
+        x_step=max(1, px(layout.x_step)),
+        x_margin=px(layout.x_margin),
+        max_width=px(layout.max_width),
+        time_string_width=px(layout.time_string_width),
+        artist_name_width=px(layout.artist_name_width),
+        album_name_width=px(layout.album_name_width),
+        track_name_width=px(layout.track_name_width),
+        margin=max(1, px(layout.margin)),
+    )
+
+
+def render(
+    user_id,
+    user_name,
+    artist_name,
+    track_name,
+    album_name,
+    release_date,
+    played_at,
+    *args,
+    trace_id=None,
+    layout=None,
+    theme="default",
+    size="1x",
+    variant=None,
+    **kwargs,
+):
+    started = time.perf_counter()
+    if layout is None:
+        layout = plan_layout(
+            user_name, artist_name, track_name, album_name, release_date, played_at
+        )
+    layout = scale_layout(layout, SIZES[size])
+    if settings.RENDER_MODE == "rgb" and theme == "default" and size == "1x":
+        n_frames, n_bytes = render_rgb(user_id, layout, variant, trace_id)
+    else:
+        n_frames, n_bytes = render_palette(
+            user_id, layout, THEMES[theme], variant, trace_id
+        )
+    metrics.RENDER_FRAMES.observe(n_frames)
+    metrics.RENDER_BYTES.observe(n_bytes)
+    metrics.RENDER_SECONDS.observe(time.perf_counter() - started)
+
+
+def text_strip(text, font, theme, role):
+    """
+    Renders `text` once into a palette image plus paste mask. The anti-aliasing
+    coverage is snapped to the AA_LEVELS shades of the `role` color.
+    """
+    palette, shade_indices = build_palette(theme)
+    base = shade_indices[role]
+    lut = [0] + [
+        base + min(AA_LEVELS, max(1, round(v * AA_LEVELS / 255))) - 1
+        for v in range(1, 256)
+    ]
+    text_width, text_height = font.getsize(text)
+    coverage = Image.new("L", (max(1, text_width), text_height))
+    ImageDraw.Draw(coverage).text((0, 0), text, font=font, fill=255)
+    indices = coverage.point(lut)
+    strip = Image.frombytes("P", indices.size, indices.tobytes())
+    strip.putpalette(palette)
+    mask = coverage.point(lambda v: 255 if v * AA_LEVELS >= 128 else 0)
+    return strip, mask
+
+
+def render_palette(
+    user_id, layout, theme=THEMES["default"], variant=None, trace_id=None
+):
+    """
+    Draws straight into indexed frames sharing one fixed palette. Every text
+    is rasterized once and pasted per frame, and the gif is encoded without
+    any quantization.
+    """
+    width = layout.width
+    height = layout.height
+    font_size = layout.font_size
+    x_margin = layout.x_margin
+    max_width = layout.max_width
+    margin = layout.margin
+    font = get_font(font_size)
+
+    time_strip = text_strip(layout.time_string, font, theme, "time_color")
+    artist_strip = text_strip(layout.artist_name, font, theme, "artist_album_color")
+    album_strip = text_strip(layout.album_name, font, theme, "artist_album_color")
+    track_strip = text_strip(layout.track_name, font, theme, "track_color")
+    label_strips = [
+        text_strip("artist:", font, theme, "artist_album_color"),
+        text_strip("album:", font, theme, "artist_album_color"),
+        text_strip("track:", font, theme, "track_color"),
+    ]
+
+    def paste(im, text, x, y):
+        strip, mask = text
+        im.paste(strip, (x, y), mask)
+
+    def frame(
+        x_offset,
+        scroll_time=False,
+        scroll_artist=False,
+        scroll_album=False,
+        scroll_track=False,
+    ):
+        im = get_background_image(width, height, "P", theme, margin)
+        draw = ImageDraw.Draw(im)
+
+        y = font_size
+        for strip, scroll in (
+            (artist_strip, scroll_artist),
+            (album_strip, scroll_album),
+            (track_strip, scroll_track),
+        ):
+            if scroll:
+                paste(im, strip, x_offset, y)
+                paste(im, strip, x_offset + x_margin + max_width, y)
+            else:
+                paste(im, strip, x_margin, y)
+            y += font_size
+
+        draw.rectangle(
+            [(0, margin), (x_margin, height - margin)], fill=BACKGROUND_INDEX
+        )
+        draw.rectangle(
+            [(width - margin, margin), (width, height - margin)],
+            fill=BACKGROUND_INDEX,
+        )
+
+        if scroll_time:
+            paste(im, time_strip, x_offset - x_margin, 0)
+            paste(im, time_strip, x_offset + max_width + margin, 0)
+        else:
+            paste(im, time_strip, margin, 0)
+
+        y = font_size
+        for label in label_strips:
+            paste(im, label, margin, y)
+            y += font_size
+        draw.rectangle(
+            [(0, margin), (margin, height - margin)],
+            fill=BACKGROUND_INDEX,
+        )
+        return im
+
+    x_offset = x_margin
+    frames = [frame(x_offset)]
+    if layout.scroll:
+        frames.extend(frame(x_offset) for i in range(10))
+        for i in range(0, max_width + x_margin - layout.x_step, layout.x_step):
+            x_offset -= layout.x_step
+            frames.append(
+                frame(
+                    x_offset,
+                    layout.scroll_time,
+                    layout.scroll_artist,
+                    layout.scroll_album,
+                    layout.scroll_track,
+                )
+            )
+
+    output = io.BytesIO()
+    with tracing.span("encode", user_id, trace_id):
+        frames[0].save(
+            output,
+            format="GIF",
+            save_all=True,
+            append_images=frames[1:],
+            duration=10,
+            loop=0,
+            transparency=TRANSPARENT_INDEX,
+            optimize=False,
+        )
+    data = output.getvalue()
+    storage.publish_bytes(data, user_id, "gif", variant)
+    return len(frames), len(data)
+
+
+def render_rgb(user_id, layout, variant=None, trace_id=None):
+    images = []
+    width = layout.width
+    height = layout.height
+    font_size = layout.font_size
+    x_step = layout.x_step
+    x_margin = layout.x_margin
+    max_width = layout.max_width
+    time_string = layout.time_string
+    artist_name = layout.artist_name
+    album_name = layout.album_name
+    track_name = layout.track_name
+
+    font = get_font(font_size)
+
     x_offset = x_margin
     index = 0
 
@@ -195,15 +512,14 @@ def render(
         index += 1
         return filename
 
-    with tempfile.TemporaryDirectory(dir=current_dir) as tmpdirname:
+    with tempfile.TemporaryDirectory() as tmpdirname:
         images.append(frame(tmpdirname, x_offset))
 
-        excess_width = (max_width + x_margin) - (width - right_margin)
-        if excess_width > 0:
-            scroll_time = (time_string_width) > (width - right_margin)
-            scroll_artist = (artist_name_width + x_margin) > (width - right_margin)
-            scroll_track = (track_name_width + x_margin) > (width - right_margin)
-            scroll_album = (album_name_width + x_margin) > (width - right_margin)
+        if layout.scroll:
+            scroll_time = layout.scroll_time
+            scroll_artist = layout.scroll_artist
+            scroll_track = layout.scroll_track
+            scroll_album = layout.scroll_album
             for i in range(10):
                 images.append(frame(tmpdirname, x_offset))
             for i in range(0, max_width + x_margin - x_step, x_step):
@@ -219,20 +535,232 @@ def render(
                     )
                 )
         output_filename = f"{tmpdirname}/final.gif"
-        gifsicle(
-            images,
-            output_filename,
-            optimize=False,
-            colors=7,
-            options=["--delay", "1", "--transparent", "#000000", "--loopcount"],
+        with tracing.span("encode", user_id, trace_id):
+            gifsicle(
+                images,
+                output_filename,
+                optimize=False,
+                colors=7,
+                options=["--delay", "1", "--transparent", "#000000", "--loopcount"],
+            )
+        storage.publish_file(output_filename, user_id, "gif", variant)
+        return len(images), os.path.getsize(output_filename)
+
+
+def svg_color(color):
+    return "#%02x%02x%02x" % color
+
+
+def render_svg(
+    user_id,
+    user_name,
+    artist_name,
+    track_name,
+    album_name,
+    release_date,
+    played_at,
+    *args,
+    layout=None,
+    theme="default",
+    size="1x",
+    variant=None,
+    **kwargs,
+):
+    """
+    Vector version of the gif, overflowing rows scroll with a css marquee
+    timed like the gif frames (10 still frames, then x_step px per frame).
+    """
+    if layout is None:
+        layout = plan_layout(
+            user_name, artist_name, track_name, album_name, release_date, played_at
         )
-        copyfile(output_filename, f"./images/{user_id}.gif")
+    svg = build_svg(scale_layout(layout, SIZES[size]), THEMES[theme])
+    storage.publish_bytes(svg.encode("utf-8"), user_id, "svg", variant)
+
+
+def build_svg(layout, theme=THEMES["default"]):
+    width = layout.width
+    height = layout.height
+    font_size = layout.font_size
+    x_margin = layout.x_margin
+    margin = layout.margin
+    distance = layout.max_width + x_margin
+    still_frames = 10
+    scroll_frames = max(1, (distance - layout.x_step) // layout.x_step)
+    duration = (still_frames + scroll_frames) * settings.SVG_SECONDS_PER_FRAME
+    hold = 100.0 * still_frames / (still_frames + scroll_frames)
+    scroll_end = (distance // layout.x_step) * layout.x_step
+
+    def row(text, y, css_class, x, scrolls, second_x):
+        text = escape(text)
+        if not scrolls:
+            return f'<text x="{x}" y="{y}" class="{css_class}">{text}</text>'
+        return (
+            f'<g class="s"><text x="{x}" y="{y}" class="{css_class}">{text}</text>'
+            f'<text x="{second_x}" y="{y}" class="{css_class}">{text}</text></g>'
+        )
+
+    value_x = x_margin
+    second_value_x = x_margin + x_margin + layout.max_width
+    rows = [
+        '<g clip-path="url(#t)">',
+        row(
+            layout.time_string,
+            0,
+            "w",
+            0 if layout.scroll_time else margin,
+            layout.scroll_time,
+            x_margin + layout.max_width + margin,
+        ),
+        "</g>",
+        '<g clip-path="url(#v)">',
+        row(
+            layout.artist_name,
+            font_size,
+            "a",
+            value_x,
+            layout.scroll_artist,
+            second_value_x,
+        ),
+        row(
+            layout.album_name,
+            font_size * 2,
+            "a",
+            value_x,
+            layout.scroll_album,
+            second_value_x,
+        ),
+        row(
+            layout.track_name,
+            font_size * 3,
+            "k",
+            value_x,
+            layout.scroll_track,
+            second_value_x,
+        ),
+        "</g>",
+        f'<text x="{margin}" y="{font_size}" class="a">artist:</text>',
+        f'<text x="{margin}" y="{font_size * 2}" class="a">album:</text>',
+        f'<text x="{margin}" y="{font_size * 3}" class="k">track:</text>',
+    ]
+
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}">'
+        "<style>"
+        f'text{{font-family:"Comic Sans MS",cursive,sans-serif;font-size:{font_size}px;'
+        "dominant-baseline:text-before-edge;white-space:pre}"
+        f".w{{fill:{svg_color(theme.time_color)}}}"
+        f".a{{fill:{svg_color(theme.artist_album_color)}}}"
+        f".k{{fill:{svg_color(theme.track_color)}}}"
+        f"@keyframes s{{0%,{hold:.1f}%{{transform:translateX(0)}}"
+        f"100%{{transform:translateX(-{scroll_end}px)}}}}"
+        f".s{{animation:s {duration:.2f}s linear infinite}}"
+        "</style>"
+        "<defs>"
+        f'<clipPath id="t"><rect x="{margin}" y="0" '
+        f'width="{width - margin - margin}" height="{height}"/></clipPath>'
+        f'<clipPath id="v"><rect x="{x_margin}" y="0" '
+        f'width="{width - margin - x_margin}" height="{height}"/></clipPath>'
+        "</defs>"
+        f'<rect width="{width}" height="{height}" rx="{margin * 1.5}" '
+        f'fill="{svg_color(theme.background_color)}"/>' + "".join(rows) + "</svg>"
+    )
+
+
+def build_stats_svg(title, rows):
+    """
+    Badge with a title row and up to three rows, same look as the play badge
+    """
+    width = 250
+    font_size = 15
+    height = font_size * 4 + (top_bottom_margin * 2)
+    texts = [f'<text x="{left_margin}" y="0" class="w">{escape(title)}</text>']
+    for i, row in enumerate(rows[:3], 1):
+        css_class = "k" if i == 1 else "a"
+        texts.append(
+            f'<text x="{left_margin}" y="{font_size * i}" class="{css_class}">'
+            f"{escape(row)}</text>"
+        )
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}">'
+        "<style>"
+        f'text{{font-family:"Comic Sans MS",cursive,sans-serif;font-size:{font_size}px;'
+        "dominant-baseline:text-before-edge;white-space:pre}"
+        f".w{{fill:{svg_color(time_color)}}}"
+        f".a{{fill:{svg_color(artist_album_color)}}}"
+        f".k{{fill:{svg_color(track_color)}}}"
+        "</style>"
+        "<defs>"
+        f'<clipPath id="c"><rect x="{left_margin}" y="0" '
+        f'width="{width - right_margin - left_margin}" height="{height}"/></clipPath>'
+        "</defs>"
+        f'<rect width="{width}" height="{height}" rx="{left_margin * 1.5}" '
+        f'fill="{svg_color(background_color)}"/>'
+        '<g clip-path="url(#c)">' + "".join(texts) + "</g></svg>"
+    )
+
+
+def render_variants(theme=None, size=None):
+    """
+    (theme, size, variant) tuples to render: the users own choice as the
+    plain {user_id}.{ext} plus every RENDER_VARIANTS entry ("{theme}.{size}")
+    as {user_id}.{theme}.{size}.{ext}
+    """
+    theme = theme if theme in THEMES else "default"
+    size = size if size in SIZES else "1x"
+    variants = [(theme, size, None)]
+    for variant in settings.RENDER_VARIANTS:
+        variant_theme, _, variant_size = variant.partition(".")
+        if variant_theme in THEMES and variant_size in SIZES:
+            variants.append((variant_theme, variant_size, variant))
+    return variants
+
+
+def render_all(
+    user_id,
+    user_name,
+    artist_name,
+    track_name,
+    album_name,
+    release_date,
+    played_at,
+    *args,
+    theme=None,
+    size=None,
+    **kwargs,
+):
+    """
+    One render job per play, the texts are measured and the scrolling is
+    planned once and shared by every variant and format.
+    """
+    layout = plan_layout(
+        user_name, artist_name, track_name, album_name, release_date, played_at
+    )
+    for variant_theme, variant_size, variant in render_variants(theme, size):
+        for render_format, render_function in (("gif", render), ("svg", render_svg)):
+            if render_format in settings.RENDER_FORMATS:
+                render_function(
+                    user_id,
+                    user_name,
+                    artist_name,
+                    track_name,
+                    album_name,
+                    release_date,
+                    played_at,
+                    layout=layout,
+                    theme=variant_theme,
+                    size=variant_size,
+                    variant=variant,
+                    **kwargs,
+                )
 
 
-async def render_async(*args, **kwargs):
+async def render_async(*args, executor=None, **kwargs):
     loop = asyncio.get_event_loop()
     try:
-        await loop.run_in_executor(None, lambda: render(*args, **kwargs))
+        await loop.run_in_executor(executor, lambda: render_all(*args, **kwargs))
     except:
         logging.exception("err")
 
@@ -1,14 +1,64 @@
 from os import environ
 
-DB_FILE = "data/statusburo.db"
+DB_FILE = environ.get("DB_FILE", "data/statusburo.db")
+PORT = int(environ.get("PORT", 9002))
 SPOTIFY_CALLBACK_URL = environ.get(
     "SPOTIFY_CALLBACK_URL", "http://127.0.0.1:9002/spotify/create"
 )
-SPOTIFY_CLIENT_ID = environ["SPOTIFY_CLIENT_ID"]
-SPOTIFY_CLIENT_SECRET = environ["SPOTIFY_CLIENT_SECRET"]
+SPOTIFY_CLIENT_ID = environ.get("SPOTIFY_CLIENT_ID")
+SPOTIFY_CLIENT_SECRET = environ.get("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_CRON_INTERVAL_SECONDS = int(environ.get("SPOTIFY_CRON_INTERVAL_SECONDS", 10))
 SPOTIFY_MINUTES_BETWEEN_REFRESH = int(
     environ.get("SPOTIFY_MINUTES_BETWEEN_REFRESH", 10)
 )
 SPOTIFY_COOKIE_NAME = "statusburo.spotify"
+SPOTIFY_ACCOUNTS_URL = environ.get(
+    "SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com"
+)
+SPOTIFY_API_URL = environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+CRON_ENABLED = int(environ.get("CRON_ENABLED", 1))
 TESTING = int(environ.get("TESTING", 0))
+WORKERS = int(environ.get("WORKERS", 1))
+LEADER_LOCK_FILE = environ.get("LEADER_LOCK_FILE", "data/leader.lock")
+LEADER_RETRY_SECONDS = int(environ.get("LEADER_RETRY_SECONDS", 5))
+WALL_RELAY_INTERVAL_SECONDS = int(environ.get("WALL_RELAY_INTERVAL_SECONDS", 1))
+ADMIN_TOKEN = environ.get("ADMIN_TOKEN")
+PROFILE_DIR = environ.get("PROFILE_DIR", "data/profiles")
+PROFILE_INTERVAL_MS = int(environ.get("PROFILE_INTERVAL_MS", 5))
+METRICS_DIR = environ.get("METRICS_DIR", "data/metrics")
+METRICS_FLUSH_SECONDS = float(environ.get("METRICS_FLUSH_SECONDS", 5))
+TRACE_SLOW_SPAN_MS = float(environ.get("TRACE_SLOW_SPAN_MS", 0))
+RENDER_MODE = environ.get("RENDER_MODE", "palette")
+RENDER_FORMATS = environ.get("RENDER_FORMATS", "gif,svg").split(",")
+SVG_SECONDS_PER_FRAME = float(environ.get("SVG_SECONDS_PER_FRAME", 0.1))
+# extra "{theme}.{size}" renders per play, served as /images/{uuid}.{theme}.{size}.gif
+RENDER_VARIANTS = [v for v in environ.get("RENDER_VARIANTS", "").split(",") if v]
+RENDER_CACHE_BYTES = int(environ.get("RENDER_CACHE_BYTES", 8 * 1024 * 1024))
+IMAGES_DIR = environ.get("IMAGES_DIR", "./images")
+STORAGE_GC_INTERVAL_SECONDS = int(environ.get("STORAGE_GC_INTERVAL_SECONDS", 3600))
+# keep the flat IMAGES_DIR/{name} of images from before the sharding as links
+STORAGE_FLAT_LINKS = int(environ.get("STORAGE_FLAT_LINKS", 1))
+STORAGE_QUOTA_BYTES = int(environ.get("STORAGE_QUOTA_BYTES", 0))
+SPOTIFY_FETCH_LIMIT = int(environ.get("SPOTIFY_FETCH_LIMIT", 50))
+STATS_DAY_RETENTION_DAYS = int(environ.get("STATS_DAY_RETENTION_DAYS", 14))
+STATS_WEEK_RETENTION_WEEKS = int(environ.get("STATS_WEEK_RETENTION_WEEKS", 12))
+STATS_COMPACT_INTERVAL_SECONDS = int(
+    environ.get("STATS_COMPACT_INTERVAL_SECONDS", 3600)
+)
+WARM_START = int(environ.get("WARM_START", 1))
+WARM_START_CONCURRENCY = int(environ.get("WARM_START_CONCURRENCY", 4))
+WARM_START_USERS_PER_SECOND = float(environ.get("WARM_START_USERS_PER_SECOND", 5))
+# cold import budget of `statusburo check-startup` and the startup tests
+STARTUP_BUDGET_MS = float(environ.get("STARTUP_BUDGET_MS", 800))
+
+REQUIRED = ["SPOTIFY_CLIENT_ID", "SPOTIFY_CLIENT_SECRET"]
+
+
+def validate():
+    """
+    Called when the server starts instead of failing at import, so the cli
+    and tooling can import settings without spotify credentials.
+    """
+    missing = [name for name in REQUIRED if not globals()[name]]
+    if missing:
+        raise RuntimeError(f"missing required settings: {', '.join(missing)}")
@@ -1,6 +1,19 @@
 import time
 import asyncio
-from statusburo import settings, utils, db, rendering, static
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from statusburo import (
+    settings,
+    utils,
+    db,
+    themes,
+    static,
+    broker,
+    metrics,
+    profiling,
+    tracing,
+    storage,
+)
 from urllib.parse import urlencode
 from typing import NamedTuple
 from sanic import Blueprint, response
@@ -8,18 +21,23 @@ import logging
 import json
 import os
 
-SPOTIFY_INDEX_TEMPLATE = static.templates["spotify_index_html"]
+AUTH_URL = settings.SPOTIFY_ACCOUNTS_URL + "/authorize"
+TOKEN_URL = settings.SPOTIFY_ACCOUNTS_URL + "/api/token"
+API_URL = settings.SPOTIFY_API_URL
 
-AUTH_URL = "https://accounts.spotify.com/authorize"
-TOKEN_URL = "https://accounts.spotify.com/api/token"
-API_URL = "https://api.spotify.com/v1"
+
+# the wall is a grid, every badge shows at the 1x size whatever the users size
+WALL_WIDTH, WALL_HEIGHT = themes.DISPLAY_SIZES["1x"]
 
 
 async def get_latest_gif_wall(n):
     uuids = await db.singleton.spotify_get_latest_public(n)
     html = ""
     for uuid in uuids:
-        html += f'<img class="gif-wall-item" src="/images/{uuid}.gif"/>'
+        html += (
+            f'<img class="gif-wall-item" src="/images/{uuid}.gif" '
+            f'width="{WALL_WIDTH}" height="{WALL_HEIGHT}"/>'
+        )
     return html
 
 
@@ -51,6 +69,8 @@ class SpotifyAuth(NamedTuple):
 blueprint = Blueprint("spotify")
 
 cron_task = None
+relay_task = None
+warm_start_task = None
 
 
 def start_cron(http_session):
@@ -59,50 +79,112 @@ def start_cron(http_session):
 
 
 async def cron(http_session):
+    # the render stack (PIL, gifsicle, timeago) is only loaded by the process
+    # that renders, http only workers never import it
+    from statusburo import rendering
+
     logging.info("Starting spotify cron")
     try:
         while True:
+            round_started = time.perf_counter()
+            profiled = profiling.begin("cron")
             futures = []
-            rows = await db.singleton.spotify_get()
-
-            for row in rows:
-                last_success_fetch = row["last_success_fetch"]
-                fetch_fails_since_last = row["fetch_fails_since_last"]
-                auth = SpotifyAuth(
-                    row["user_id"],
-                    row["access_token"],
-                    row["refresh_token"],
-                    row["token_expires_at"],
-                )
-                async with http_session() as session:
-                    try:
-                        auth, data = await get_latest_listens(
-                            session, auth, after=row["last_success_fetch"], n=1
-                        )
-                    except:
-                        logging.exception(
-                            f"got err getting latest listens for {auth.user_id}"
-                        )
-                        continue
-                    try:
-                        if data:
-                            data = data[0]
-                            logging.debug(f"got data from spotify: {data}")
-                            futures.append(
-                                rendering.render_async(
-                                    user_name=row["user_name"],
-                                    user_id=auth.user_id,
-                                    **data,
+            try:
+                events = []
+                rows = await db.singleton.spotify_get()
+
+                for row in rows:
+                    last_success_fetch = row["last_success_fetch"]
+                    metrics.USER_STALENESS_SECONDS.observe(
+                        time.time() - last_success_fetch / 1000.0
+                    )
+                    fetch_fails_since_last = row["fetch_fails_since_last"]
+                    auth = SpotifyAuth(
+                        row["user_id"],
+                        row["access_token"],
+                        row["refresh_token"],
+                        row["token_expires_at"],
+                    )
+                    trace_id = tracing.new_trace_id()
+                    async with http_session() as session:
+                        try:
+                            with tracing.span("fetch", auth.user_id, trace_id):
+                                auth, data = await get_latest_listens(
+                                    session,
+                                    auth,
+                                    after=row["last_success_fetch"],
+                                    n=settings.SPOTIFY_FETCH_LIMIT,
                                 )
+                        except:
+                            logging.exception(
+                                f"got err getting latest listens for {auth.user_id}"
                             )
-                            futures.append(
-                                db.singleton.spotify_update(
-                                    played_at=data["played_at"], **auth._asdict()
+                            continue
+                        try:
+                            if data:
+                                plays = data
+                                data = max(data, key=lambda play: play["played_at"])
+                                logging.debug(f"got data from spotify: {data}")
+                                futures.append(
+                                    tracing.traced(
+                                        rendering.render_async(
+                                            user_name=row["user_name"],
+                                            user_id=auth.user_id,
+                                            trace_id=trace_id,
+                                            theme=row["theme"],
+                                            size=row["size"],
+                                            **data,
+                                        ),
+                                        "render",
+                                        auth.user_id,
+                                        trace_id,
+                                    )
                                 )
-                            )
-                    except:
-                        logging.exception("Error during rendering")
-            await asyncio.gather(*futures)
+                                futures.append(
+                                    tracing.traced(
+                                        db.singleton.spotify_record_fetch(
+                                            plays=plays,
+                                            played_at=data["played_at"],
+                                            **auth._asdict(),
+                                        ),
+                                        "db_update",
+                                        auth.user_id,
+                                        trace_id,
+                                    )
+                                )
+                                if row["public"]:
+                                    events.append(
+                                        (
+                                            trace_id,
+                                            {
+                                                "user_id": auth.user_id,
+                                                "played_at": int(
+                                                    data["played_at"].timestamp()
+                                                    * 1000.0
+                                                ),
+                                            },
+                                        )
+                                    )
+                        except:
+                            logging.exception("Error during rendering")
+                results = await asyncio.gather(*futures, return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        # the users cursor didn't move, the next round retries it
+                        logging.error("Error in cron task", exc_info=result)
+                for trace_id, event in events:
+                    with tracing.span("publish", event["user_id"], trace_id):
+                        broker.singleton.publish(event)
+                metrics.CRON_ROUND_SECONDS.observe(time.perf_counter() - round_started)
+            except asyncio.CancelledError:
+                raise
+            except:
+                # a failed round (e.g. the db is locked by another worker) must
+                # not end the cron, the leader would keep the lock and idle
+                logging.exception("cron round errored")
+            finally:
+                if profiled:
+                    profiling.end("cron")
             if not futures:
                 await asyncio.sleep(settings.SPOTIFY_CRON_INTERVAL_SECONDS)
     except:
@@ -111,7 +193,216 @@ async def cron(http_session):
 
 
 def stop_cron():
-    cron_task.cancel()
+    if cron_task:
+        cron_task.cancel()
+
+
+def start_warm_start(http_session):
+    global warm_start_task
+    warm_start_task = asyncio.get_event_loop().create_task(warm_start(http_session))
+
+
+async def warm_start(http_session):
+    """
+    Rebuilds the gifs of users whose gif is missing on disk (new volume,
+    redeploy) from their latest play. Runs next to the cron at a throttled
+    rate on its own render pool, so http keeps being served meanwhile.
+    """
+    from statusburo import rendering
+
+    rows = await db.singleton.spotify_get_all()
+    ext = settings.RENDER_FORMATS[0]
+    missing = [
+        row
+        for row in rows
+        if not os.path.exists(storage.image_path(row["user_id"], ext))
+    ]
+    logging.info({"message": "warm start", "users": len(rows), "missing": len(missing)})
+    if not missing:
+        return
+
+    remaining = len(missing)
+    metrics.WARM_START_REMAINING.set(remaining)
+    semaphore = asyncio.Semaphore(settings.WARM_START_CONCURRENCY)
+    executor = ThreadPoolExecutor(settings.WARM_START_CONCURRENCY)
+
+    async def rebuild(session, row):
+        nonlocal remaining
+        outcome = "error"
+        try:
+            auth = SpotifyAuth(
+                row["user_id"],
+                row["access_token"],
+                row["refresh_token"],
+                row["token_expires_at"],
+            )
+            refreshed, data = await get_latest_listens(session, auth, after=None, n=1)
+            if refreshed != auth:
+                await db.singleton.spotify_update_tokens(**refreshed._asdict())
+            if data:
+                data = data[0]
+                # only the image is rebuilt, last_success_fetch is left for the
+                # cron so it still counts every play since then
+                await rendering.render_async(
+                    user_name=row["user_name"],
+                    user_id=auth.user_id,
+                    executor=executor,
+                    theme=row["theme"],
+                    size=row["size"],
+                    **data,
+                )
+                outcome = "rebuilt"
+            else:
+                outcome = "no_plays"
+        except:
+            logging.exception(f"warm start failed for {row['user_id']}")
+        finally:
+            semaphore.release()
+            remaining -= 1
+            metrics.WARM_START_REMAINING.set(remaining)
+            metrics.WARM_START_REBUILT.inc(outcome=outcome)
+            if remaining % 100 == 0:
+                logging.info(
+                    {
+                        "message": "warm start progress",
+                        "remaining": remaining,
+                        "missing": len(missing),
+                    }
+                )
+
+    try:
+        async with http_session() as session:
+            futures = []
+            for row in missing:
+                await semaphore.acquire()
+                futures.append(asyncio.ensure_future(rebuild(session, row)))
+                await asyncio.sleep(1.0 / settings.WARM_START_USERS_PER_SECOND)
+            await asyncio.gather(*futures)
+    finally:
+        executor.shutdown(wait=False)
+    logging.info({"message": "warm start done", "missing": len(missing)})
+
+
+def stop_warm_start():
+    if warm_start_task:
+        warm_start_task.cancel()
+
+
+gc_task = None
+
+
+def start_storage_gc():
+    global gc_task
+    gc_task = asyncio.get_event_loop().create_task(
+        storage_gc(settings.STORAGE_GC_INTERVAL_SECONDS)
+    )
+
+
+async def storage_gc(interval):
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            user_ids = set(await db.singleton.spotify_get_all_user_ids())
+            removed = await loop.run_in_executor(
+                None,
+                lambda: storage.collect_garbage(user_ids, settings.STORAGE_QUOTA_BYTES),
+            )
+            logging.info({"message": "storage gc", **removed})
+        except asyncio.CancelledError:
+            raise
+        except:
+            logging.exception("storage gc errored")
+        await asyncio.sleep(interval)
+
+
+def stop_storage_gc():
+    if gc_task:
+        gc_task.cancel()
+
+
+compact_task = None
+
+
+def start_stats_compaction():
+    global compact_task
+    compact_task = asyncio.get_event_loop().create_task(
+        stats_compaction(settings.STATS_COMPACT_INTERVAL_SECONDS)
+    )
+
+
+async def stats_compaction(interval):
+    while True:
+        try:
+            await db.singleton.spotify_compact_play_counts(
+                settings.STATS_DAY_RETENTION_DAYS, settings.STATS_WEEK_RETENTION_WEEKS
+            )
+        except asyncio.CancelledError:
+            raise
+        except:
+            logging.exception("stats compaction errored")
+        await asyncio.sleep(interval)
+
+
+def stop_stats_compaction():
+    if compact_task:
+        compact_task.cancel()
+
+
+async def get_stats(user_id, n=10):
+    now = datetime.datetime.utcnow()
+    stats = {"user_id": user_id}
+    for period, bucket in (
+        ("day", db.day_bucket(now)),
+        ("week", db.week_bucket(now)),
+    ):
+        stats[period] = {"bucket": bucket}
+        for kind in ("artist", "track"):
+            rows = await db.singleton.spotify_get_top_plays(
+                user_id, period, bucket, kind, n
+            )
+            stats[period][f"{kind}s"] = [
+                {"name": name, "plays": plays} for name, plays in rows
+            ]
+    return stats
+
+
+def start_wall_relay():
+    global relay_task
+    relay_task = asyncio.get_event_loop().create_task(
+        wall_relay(settings.WALL_RELAY_INTERVAL_SECONDS)
+    )
+
+
+async def wall_relay(interval):
+    """
+    Workers that don't run the cron never see its events, so they
+    pick up new public gifs from the db and publish them to their own
+    broker. Only polls while somebody is subscribed.
+    """
+    latest = None
+    try:
+        while True:
+            if not broker.singleton.subscribers:
+                latest = None
+            else:
+                rows = await db.singleton.spotify_get_latest_public_fetches(30)
+                if latest is not None:
+                    for user_id, played_at in reversed(rows):
+                        if latest.get(user_id) != played_at:
+                            broker.singleton.publish(
+                                {"user_id": user_id, "played_at": played_at}
+                            )
+                latest = dict(rows)
+            await asyncio.sleep(interval)
+    except asyncio.CancelledError:
+        raise
+    except:
+        logging.exception("wall relay errored")
+
+
+def stop_wall_relay():
+    if relay_task:
+        relay_task.cancel()
 
 
 def build_topic(topic, hits):
@@ -125,36 +416,93 @@ def build_topic(topic, hits):
 @blueprint.route("/", methods=["GET"])
 async def index(request):
     uuid = request.cookies.get(settings.SPOTIFY_COOKIE_NAME)
+    image_format = request.args.get("format", "gif")
+    if image_format not in settings.RENDER_FORMATS:
+        image_format = settings.RENDER_FORMATS[0]
     if uuid:
+        size = await db.singleton.spotify_get_size(uuid)
+        width, height = themes.DISPLAY_SIZES.get(size, themes.DISPLAY_SIZES["1x"])
+        image_url = f"https://status.buro.earth/images/{uuid}.{image_format}"
         return response.html(
-            SPOTIFY_INDEX_TEMPLATE.substitute(
+            static.templates["spotify_index_html"].substitute(
                 statusburo_created_snippet=(
                     '<a href="https://status.buro.earth/#spotify-form">\n'
-                    f'<img src="https://status.buro.earth/images/{uuid}.gif"/>\n'
+                    f'<img src="{image_url}" width="{width}" height="{height}"/>\n'
                     "</a>"
                 ),
                 showform="none",
                 showuserimage="block",
-                userimage=f"/images/{uuid}.gif",
+                userimage=f"/images/{uuid}.{image_format}",
+                userimage_width=width,
+                userimage_height=height,
                 gif_wall=await get_latest_gif_wall(30),
+                wall_width=WALL_WIDTH,
+                wall_height=WALL_HEIGHT,
             )
         )
     else:
         return response.html(
-            SPOTIFY_INDEX_TEMPLATE.substitute(
+            static.templates["spotify_index_html"].substitute(
                 statusburo_created_snippet="",
                 showform="block",
                 showuserimage="none",
                 userimage="",
+                userimage_width=WALL_WIDTH,
+                userimage_height=WALL_HEIGHT,
                 gif_wall=await get_latest_gif_wall(30),
+                wall_width=WALL_WIDTH,
+                wall_height=WALL_HEIGHT,
             )
         )
 
 
+@blueprint.route("/spotify/wall/events", methods=["GET"])
+async def index(request):
+    async def stream_events(resp):
+        try:
+            await resp.write(broker.format_sse(None))
+            async for event in broker.singleton.subscribe():
+                await resp.write(broker.format_sse(event, "gif"))
+        except broker.SlowConsumer:
+            logging.debug("dropped slow gif wall subscriber")
+
+    return response.stream(
+        stream_events,
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@blueprint.route("/spotify/<uuid>/stats.json", methods=["GET"])
+async def index(request, uuid):
+    if not storage.valid_user_id(uuid):
+        return response.text("Not found", status=404)
+    return response.json(await get_stats(uuid), headers={"Cache-Control": "max-age=60"})
+
+
+@blueprint.route("/spotify/<uuid>/stats.svg", methods=["GET"])
+async def index(request, uuid):
+    from statusburo import rendering
+
+    if not storage.valid_user_id(uuid):
+        return response.text("Not found", status=404)
+    stats = await get_stats(uuid, n=3)
+    rows = [
+        f"{i}. {artist['name']} ({artist['plays']})"
+        for i, artist in enumerate(stats["week"]["artists"], 1)
+    ]
+    return response.text(
+        rendering.build_stats_svg("top artists this week", rows),
+        content_type="image/svg+xml",
+        headers={"Cache-Control": "max-age=60"},
+    )
+
+
 @blueprint.route("/spotify/signout", methods=["GET"])
 async def index(request):
     user_id = request.cookies.get(settings.SPOTIFY_COOKIE_NAME)
     await db.singleton.spotify_delete(user_id)
+    storage.remove(user_id)
     resp = response.redirect("https://www.spotify.com/us/account/apps/")
     del resp.cookies[settings.SPOTIFY_COOKIE_NAME]
     return resp
@@ -164,11 +512,18 @@ async def index(request):
     uuid = utils.create_uuid()
     username = request.form.get("username")
     public = request.form.get("public") == "public"
+    theme = request.form.get("theme")
+    size = request.form.get("size")
+    state = {"uuid": uuid, "username": username, "public": public}
+    if theme in themes.THEMES:
+        state["theme"] = theme
+    if size in themes.SIZES:
+        state["size"] = size
 
     return response.redirect(
         get_spotify_auth_link(
             json.dumps(
-                {"uuid": uuid, "username": username, "public": public},
+                state,
                 separators=(",", ":"),
             )
         )
@@ -187,6 +542,8 @@ async def index(request):
     uuid = state["uuid"]
     user_name = state["username"]
     public = state["public"]
+    theme = state.get("theme")
+    size = state.get("size")
 
     headers = {"Accept": "application/json"}
     data = dict(
@@ -198,9 +555,13 @@ async def index(request):
     )
 
     async with request.app.http_session() as session:
+        started = time.perf_counter()
         async with session.post(TOKEN_URL, headers=headers, data=data) as http_response:
             response_data = await http_response.json()
             status = http_response.status
+            metrics.SPOTIFY_REQUEST_SECONDS.observe(
+                time.perf_counter() - started, endpoint="token", status=status
+            )
 
             if status >= 400:
                 cause = response_data.get("error")
@@ -219,11 +580,11 @@ async def index(request):
         token_expires_at=int(time.time()) + int(response_data["expires_in"]),
     )
     await db.singleton.spotify_create(
-        user_name=user_name, public=public, **auth._asdict()
+        user_name=user_name, public=public, theme=theme, size=size, **auth._asdict()
     )
     sleep_n = 30
     for i in range(sleep_n):
-        if os.path.exists("/images/{uuid}.gif"):
+        if os.path.exists(storage.image_path(uuid)):
             break
         asyncio.sleep(4/sleep_n)
     asyncio.sleep(1)
@@ -239,19 +600,27 @@ async def refresh_token(session, auth):
         grant_type="refresh_token",
         refresh_token=auth.refresh_token,
     )
+    started = time.perf_counter()
     async with session.post(TOKEN_URL, data=data) as response:
+        metrics.SPOTIFY_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            endpoint="refresh_token",
+            status=response.status,
+        )
+        metrics.SPOTIFY_TOKEN_REFRESHES.inc(status=response.status)
+        if response.status == 400:
+            try:
+                error_data = await response.json(content_type=None)
+            except ValueError:
+                error_data = {}
+            if error_data.get("error") == "invalid_grant":
+                # the user revoked our access on spotify
+                await db.singleton.spotify_delete(auth.user_id)
+                storage.remove(auth.user_id)
         response.raise_for_status()
 
         response_data = await response.json()
 
-        status = response.status
-
-    if status >= 400:
-        cause = response_data.get("error")
-        cause_description = response_data.get("error_description")
-        if status == 400 and cause == "invalid_grant":
-            await db.singleton.spotify_delete(auth.user_id)
-
     return SpotifyAuth(
         user_id=auth.user_id,
         access_token=response_data["access_token"],
@@ -261,6 +630,9 @@ async def refresh_token(session, auth):
 
 
 async def get_latest_listens(session, auth, tries=3, after=0, n=1):
+    """
+    after=None fetches the latest plays instead of the plays since `after`
+    """
     if auth.token_expires_at - time.time() <= 60:
         auth = await refresh_token(session, auth)
 
@@ -269,17 +641,25 @@ async def get_latest_listens(session, auth, tries=3, after=0, n=1):
         "Authorization": f"Bearer {auth.access_token}",
     }
 
+    started = time.perf_counter()
+    query = f"limit={n}" if after is None else f"limit={n}&after={after}"
     async with session.get(
-        API_URL + f"/me/player/recently-played?limit={n}&after={after}", headers=headers
+        API_URL + f"/me/player/recently-played?{query}", headers=headers
     ) as response:
+        metrics.SPOTIFY_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            endpoint="recently_played",
+            status=response.status,
+        )
         if response.status == 429:
+            metrics.SPOTIFY_RATE_LIMITED.inc(endpoint="recently_played")
             tries -= 1
             if tries >= 0:
                 logging.warning(
                     f"got rate limited, sleeping {response.headers['Retry-After']} seconds"
                 )
                 await asyncio.sleep(int(response.headers["Retry-After"]))
-                return await get_latest_listens(session, auth, tries, n)
+                return await get_latest_listens(session, auth, tries, after=after, n=n)
 
         response.raise_for_status()
         data = await response.json()
@@ -1,10 +1,96 @@
+"""
+Asset pipeline, run once at startup by `build()`.
+Images and css get content hashed urls (/static/{name}.{hash}{ext}) and are
+kept in memory precompressed, css is inlined into the html templates.
+Templates refer to assets as $static_{name} and $css_{name}, with dots
+replaced by underscores like the template names.
+"""
 import os
+import re
 import glob
+import gzip
 import string
+import hashlib
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 path = os.path.dirname(__file__)
-templates = {
-    fn.rsplit("/", 1)[1].replace(".", "_"): string.Template(open(fn).read())
-    for fn in glob.glob(path + "/*.html")
-}
-css_files = {fn.rsplit("/", 1)[1]: fn for fn in glob.glob(path + "/*.css")}
+templates = {}
+assets = {}
+
+ASSET_EXTENSIONS = ("*.png", "*.jpg", "*.gif", "*.svg", "*.ico", "*.css")
+CSS_URL_PATTERN = re.compile(r"""url\(\s*["']?([^"')]+)["']?\s*\)""")
+
+
+class Asset:
+    def __init__(self, filename, body):
+        self.content_type = (
+            mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        self.body = body
+        digest = hashlib.sha256(body).hexdigest()
+        self.etag = f'"{digest[:16]}"'
+        stem, ext = os.path.splitext(filename)
+        self.name = f"{stem}.{digest[:10]}{ext}"
+        self.url = f"/static/{self.name}"
+        self.encodings = {}
+        # only keep the compressed variants that are actually smaller
+        gzipped = gzip.compress(body, compresslevel=9)
+        if len(gzipped) < len(body):
+            self.encodings["gzip"] = gzipped
+        if brotli is not None:
+            brotlied = brotli.compress(body, quality=11)
+            if len(brotlied) < len(body):
+                self.encodings["br"] = brotlied
+
+    def negotiate(self, accept_encoding):
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and encoding in accept_encoding:
+                return self.encodings[encoding], encoding
+        return self.body, None
+
+
+def template_key(filename):
+    return os.path.basename(filename).replace(".", "_")
+
+
+def escape_template(value):
+    return value.replace("$", "$$")
+
+
+def build():
+    urls = {}
+    css_files = {}
+    for pattern in ASSET_EXTENSIONS:
+        for fn in sorted(glob.glob(os.path.join(path, pattern))):
+            if fn.endswith(".css"):
+                css_files[os.path.basename(fn)] = open(fn).read()
+                continue
+            with open(fn, "rb") as f:
+                asset = Asset(os.path.basename(fn), f.read())
+            assets[asset.name] = asset
+            urls[os.path.basename(fn)] = asset.url
+
+    def rewrite_url(match):
+        return f'url("{urls.get(match.group(1), match.group(1))}")'
+
+    substitutions = {}
+    for filename, css in css_files.items():
+        css = CSS_URL_PATTERN.sub(rewrite_url, css)
+        asset = Asset(filename, css.encode("utf-8"))
+        assets[asset.name] = asset
+        urls[filename] = asset.url
+        substitutions[f"css_{template_key(filename)}"] = escape_template(css)
+
+    for filename, url in urls.items():
+        substitutions[f"static_{template_key(filename)}"] = url
+
+    for fn in glob.glob(path + "/*.html"):
+        raw = string.Template(open(fn).read())
+        templates[template_key(fn)] = string.Template(
+            raw.safe_substitute(substitutions)
+        )
@@ -0,0 +1,234 @@
+"""
+Rendered images live in IMAGES_DIR/{first two chars of user_id}/{user_id}.{ext}
+(variants as {user_id}.{variant}.{ext}). Files are published atomically by
+writing a hidden temp file in the shard and renaming it over the old one.
+
+Images published before the sharding were served by the front web server
+from the flat IMAGES_DIR/{name}. While STORAGE_FLAT_LINKS is on those flat
+paths are kept as relative symlinks into the shards, so old embeds keep
+updating. New images get no flat link and the top level stays the size it
+was, the web server maps /images/{name} to the shard with the rewrite in
+nginx.images.conf.
+"""
+import os
+import re
+import stat
+import time
+import shutil
+import logging
+import threading
+
+from statusburo import settings, metrics
+
+SHARD_LENGTH = 2
+USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+IMAGE_EXTENSIONS = (".gif", ".svg")
+STALE_TMP_SECONDS = 3600
+
+
+def valid_user_id(user_id):
+    return bool(user_id and USER_ID_PATTERN.match(user_id))
+
+
+def shard_dir(user_id):
+    return os.path.join(settings.IMAGES_DIR, user_id[:SHARD_LENGTH])
+
+
+def image_name(user_id, ext="gif", variant=None):
+    if variant:
+        return f"{user_id}.{variant}.{ext}"
+    return f"{user_id}.{ext}"
+
+
+def image_path(user_id, ext="gif", variant=None):
+    return os.path.join(shard_dir(user_id), image_name(user_id, ext, variant))
+
+
+def path_for_filename(filename):
+    """
+    maps a public /images/{filename} to its path, None if it isn't an image name
+    """
+    user_id = filename.split(".", 1)[0]
+    if not valid_user_id(user_id) or "/" in filename or ".." in filename:
+        return None
+    return os.path.join(shard_dir(user_id), filename)
+
+
+def tmp_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def flat_path(name):
+    return os.path.join(settings.IMAGES_DIR, name)
+
+
+def link_flat(user_id, name):
+    """
+    Points IMAGES_DIR/{name} at the sharded file, replacing a stale flat file
+    left from before the sharding.
+    """
+    link = flat_path(name)
+    tmp = tmp_path(link)
+    os.symlink(os.path.join(user_id[:SHARD_LENGTH], name), tmp)
+    os.replace(tmp, link)
+
+
+def relink_flat(user_id, name):
+    """
+    Replaces a flat image that predates the sharding with a link, one lstat
+    per publish. Images without a flat path don't get one.
+    """
+    try:
+        mode = os.lstat(flat_path(name)).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISLNK(mode):
+        link_flat(user_id, name)
+
+
+def publish_file(source_filename, user_id, ext="gif", variant=None):
+    path = image_path(user_id, ext, variant)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tmp_path(path)
+    shutil.copyfile(source_filename, tmp)
+    os.replace(tmp, path)
+    if settings.STORAGE_FLAT_LINKS:
+        relink_flat(user_id, os.path.basename(path))
+    return path
+
+
+def publish_bytes(data, user_id, ext="gif", variant=None):
+    path = image_path(user_id, ext, variant)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tmp_path(path)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    if settings.STORAGE_FLAT_LINKS:
+        relink_flat(user_id, os.path.basename(path))
+    return path
+
+
+def remove(user_id):
+    if not valid_user_id(user_id):
+        return 0
+    try:
+        names = [
+            entry.name
+            for entry in os.scandir(shard_dir(user_id))
+            if entry.name.split(".", 1)[0] == user_id
+        ]
+    except FileNotFoundError:
+        names = []
+    # flat links and images not migrated yet
+    flat_names = set(names) | {f"{user_id}{ext}" for ext in IMAGE_EXTENSIONS}
+    paths = [os.path.join(shard_dir(user_id), name) for name in names]
+    paths += [flat_path(name) for name in flat_names]
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def migrate_flat_layout():
+    """
+    One time move of images from the old flat IMAGES_DIR/{user_id}.gif layout
+    into the shards, run by hand with `statusburo migrate-images`. A symlink
+    is left at the flat path while STORAGE_FLAT_LINKS is on.
+    Users who play something before that are moved by their next publish.
+    """
+    moved = 0
+    os.makedirs(settings.IMAGES_DIR, exist_ok=True)
+    for entry in os.scandir(settings.IMAGES_DIR):
+        if entry.is_symlink() or not entry.is_file():
+            continue
+        if not entry.name.endswith(IMAGE_EXTENSIONS):
+            continue
+        user_id = entry.name.split(".", 1)[0]
+        if not valid_user_id(user_id):
+            continue
+        target = os.path.join(shard_dir(user_id), entry.name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            # already re-rendered into the shard, the flat copy is stale
+            os.remove(entry.path)
+        else:
+            os.replace(entry.path, target)
+        if settings.STORAGE_FLAT_LINKS:
+            link_flat(user_id, entry.name)
+        moved += 1
+    if moved:
+        logging.info({"message": "migrated flat images", "moved": moved})
+    return moved
+
+
+def collect_garbage(user_ids, quota_bytes=0, min_age_seconds=600):
+    """
+    Removes images of users not in `user_ids` and stale temp files. When the
+    rest is above `quota_bytes` the least recently rendered images are evicted,
+    the cron renders them again on the users next play.
+    Files younger than `min_age_seconds` are kept, they might belong to a
+    user created after `user_ids` was read.
+    """
+    now = time.time()
+    kept = []
+    removed = {"orphan": 0, "stale_tmp": 0, "quota": 0, "dangling_link": 0}
+    total_bytes = 0
+    os.makedirs(settings.IMAGES_DIR, exist_ok=True)
+
+    links = []
+    for shard in os.scandir(settings.IMAGES_DIR):
+        if shard.is_symlink():
+            links.append(shard.path)
+            continue
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith("."):
+                if now - stat.st_mtime > STALE_TMP_SECONDS:
+                    os.remove(entry.path)
+                    removed["stale_tmp"] += 1
+                continue
+            too_young = now - stat.st_mtime < min_age_seconds
+            if entry.name.split(".", 1)[0] not in user_ids and not too_young:
+                os.remove(entry.path)
+                removed["orphan"] += 1
+                continue
+            kept.append((stat.st_mtime, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+
+    if quota_bytes and total_bytes > quota_bytes:
+        kept.sort()
+        for mtime, size, path in kept:
+            if total_bytes <= quota_bytes or now - mtime < min_age_seconds:
+                break
+            os.remove(path)
+            total_bytes -= size
+            removed["quota"] += 1
+        kept = kept[removed["quota"] :]
+
+    # flat links of removed or evicted images
+    for link in links:
+        if not os.path.exists(link):
+            try:
+                os.remove(link)
+                removed["dangling_link"] += 1
+            except FileNotFoundError:
+                pass
+
+    for reason, n in removed.items():
+        if n:
+            metrics.STORAGE_REMOVED.inc(n, reason=reason)
+    metrics.STORAGE_BYTES.set(total_bytes)
+    metrics.STORAGE_FILES.set(len(kept))
+    metrics.STORAGE_QUOTA_BYTES.set(quota_bytes)
+    return removed
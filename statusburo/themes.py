@@ -0,0 +1,23 @@
+"""
+Badge themes and sizes, kept apart from rendering so the http routes can
+validate a users choice without importing the render stack.
+"""
+from typing import NamedTuple
+
+
+class Theme(NamedTuple):
+    background_color: tuple
+    artist_album_color: tuple
+    track_color: tuple
+    time_color: tuple
+
+
+THEMES = {
+    "default": Theme((26, 26, 26), (0, 219, 212), (3, 252, 119), (255, 110, 217)),
+    "light": Theme((245, 245, 240), (0, 120, 140), (0, 140, 60), (200, 40, 140)),
+    "mono": Theme((26, 26, 26), (190, 190, 190), (255, 255, 255), (140, 140, 140)),
+}
+# scale of every pixel measure relative to the 250px wide 1x badge
+SIZES = {"1x": 1.0, "2x": 2.0, "compact": 0.8}
+# css pixels each size shows at, a 2x badge is the 1x one at twice the density
+DISPLAY_SIZES = {"1x": (250, 70), "2x": (250, 70), "compact": (200, 56)}
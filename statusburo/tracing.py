@@ -0,0 +1,58 @@
+"""
+Lightweight trace spans following one user through
+fetch -> render -> encode -> publish -> db update.
+Spans slower than `threshold_ms` are logged with their trace id,
+a threshold of 0 turns tracing off and `span` returns a shared no-op.
+"""
+import logging
+import time
+from contextlib import nullcontext
+
+from statusburo import settings, utils
+
+threshold_ms = settings.TRACE_SLOW_SPAN_MS
+
+NULL_SPAN = nullcontext()
+
+
+class Span:
+    __slots__ = ("name", "user_id", "trace_id", "started")
+
+    def __init__(self, name, user_id, trace_id):
+        self.name = name
+        self.user_id = user_id
+        self.trace_id = trace_id
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed_ms = (time.perf_counter() - self.started) * 1000.0
+        if threshold_ms and elapsed_ms >= threshold_ms:
+            logging.warning(
+                {
+                    "message": "slow span",
+                    "span": self.name,
+                    "trace": self.trace_id,
+                    "userId": self.user_id,
+                    "ms": round(elapsed_ms, 2),
+                }
+            )
+
+
+def new_trace_id():
+    if not threshold_ms:
+        return None
+    return utils.create_uuid()
+
+
+def span(name, user_id=None, trace_id=None):
+    if not threshold_ms:
+        return NULL_SPAN
+    return Span(name, user_id, trace_id)
+
+
+async def traced(awaitable, name, user_id=None, trace_id=None):
+    with span(name, user_id, trace_id):
+        return await awaitable
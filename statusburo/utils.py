@@ -1,6 +1,5 @@
 from uuid import uuid4
 from base64 import urlsafe_b64encode
-from dateutil.parser import parse
 
 
 def create_uuid():
@@ -15,4 +14,7 @@ class Redirect(Exception):
 
 
 def parse_date(datestring):
+    # dateutil is only needed by the cron, keep it out of the http workers
+    from dateutil.parser import parse
+
     return parse(datestring)
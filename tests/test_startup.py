@@ -0,0 +1,15 @@
+from statusburo import cli, settings
+
+BUDGET_MS = settings.STARTUP_BUDGET_MS
+
+
+def test_app_starts_without_the_render_stack():
+    result = cli.check_startup("statusburo.app", budget_ms=BUDGET_MS)
+    assert result["loaded"] == [], result
+    assert result["ok"], result
+
+
+def test_cli_starts_without_the_render_stack():
+    result = cli.check_startup("statusburo.cli", budget_ms=BUDGET_MS)
+    assert result["loaded"] == [], result
+    assert result["ok"], result
@@ -0,0 +1,132 @@
+import os
+import time
+
+import pytest
+
+from statusburo import settings, storage
+
+OLD = time.time() - 3600
+
+
+@pytest.fixture
+def images_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / "images")
+    monkeypatch.setattr(settings, "IMAGES_DIR", path)
+    monkeypatch.setattr(settings, "STORAGE_FLAT_LINKS", 1)
+    return path
+
+
+def publish(user_id, data=b"gif", mtime=OLD, **kwargs):
+    path = storage.publish_bytes(data, user_id, **kwargs)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def flat_file(images_dir, name, data=b"old"):
+    os.makedirs(images_dir, exist_ok=True)
+    path = os.path.join(images_dir, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def test_collect_garbage_without_images_dir(images_dir):
+    removed = storage.collect_garbage(set())
+    assert sum(removed.values()) == 0
+    assert os.path.isdir(images_dir)
+
+
+def test_collect_garbage_removes_orphans(images_dir):
+    kept = publish("keep1")
+    orphan = publish("gone1")
+    orphan_variant = publish("gone1", variant="light.2x")
+
+    removed = storage.collect_garbage({"keep1"})
+
+    assert removed["orphan"] == 2
+    assert os.path.exists(kept)
+    assert not os.path.exists(orphan)
+    assert not os.path.exists(orphan_variant)
+
+
+def test_collect_garbage_keeps_young_orphans(images_dir):
+    young = publish("new1", mtime=time.time())
+
+    removed = storage.collect_garbage(set(), min_age_seconds=600)
+
+    assert removed["orphan"] == 0
+    assert os.path.exists(young)
+
+
+def test_collect_garbage_evicts_oldest_first(images_dir):
+    oldest = publish("aaa1", b"x" * 100, mtime=OLD - 300)
+    older = publish("bbb1", b"x" * 100, mtime=OLD - 200)
+    newest = publish("ccc1", b"x" * 100, mtime=OLD - 100)
+
+    removed = storage.collect_garbage({"aaa1", "bbb1", "ccc1"}, quota_bytes=150)
+
+    assert removed["quota"] == 2
+    assert not os.path.exists(oldest)
+    assert not os.path.exists(older)
+    assert os.path.exists(newest)
+
+
+def test_collect_garbage_quota_keeps_young_files(images_dir):
+    young = publish("aaa1", b"x" * 100, mtime=time.time())
+
+    removed = storage.collect_garbage({"aaa1"}, quota_bytes=10)
+
+    assert removed["quota"] == 0
+    assert os.path.exists(young)
+
+
+def test_collect_garbage_removes_dangling_links(images_dir):
+    flat_file(images_dir, "gone1.gif")
+    flat_file(images_dir, "keep1.gif")
+    storage.migrate_flat_layout()
+    for path in (storage.image_path("gone1"), storage.image_path("keep1")):
+        os.utime(path, (OLD, OLD))
+
+    removed = storage.collect_garbage({"keep1"})
+
+    assert removed["orphan"] == 1
+    assert removed["dangling_link"] == 1
+    assert not os.path.lexists(storage.flat_path("gone1.gif"))
+    assert os.path.islink(storage.flat_path("keep1.gif"))
+
+
+def test_migrate_flat_layout_leaves_links(images_dir):
+    flat_file(images_dir, "abcd1.gif", b"old")
+
+    assert storage.migrate_flat_layout() == 1
+    assert storage.migrate_flat_layout() == 0
+
+    flat = storage.flat_path("abcd1.gif")
+    assert os.path.islink(flat)
+    assert open(flat, "rb").read() == b"old"
+    storage.publish_bytes(b"new", "abcd1")
+    assert open(flat, "rb").read() == b"new"
+
+
+def test_publish_relinks_only_existing_flat_images(images_dir):
+    flat_file(images_dir, "old1.gif")
+
+    storage.publish_bytes(b"new", "old1")
+    storage.publish_bytes(b"new", "new1")
+
+    assert os.path.islink(storage.flat_path("old1.gif"))
+    assert open(storage.flat_path("old1.gif"), "rb").read() == b"new"
+    assert not os.path.lexists(storage.flat_path("new1.gif"))
+
+
+def test_remove(images_dir):
+    flat_file(images_dir, "abcd1.gif")
+    storage.publish_bytes(b"new", "abcd1")
+    storage.publish_bytes(b"svg", "abcd1", "svg")
+    storage.publish_bytes(b"2x", "abcd1", variant="default.2x")
+    other = storage.publish_bytes(b"gif", "abcd2")
+
+    assert storage.remove("abcd1") == 4
+    assert os.listdir(storage.shard_dir("abcd1")) == [os.path.basename(other)]
+    assert not os.path.lexists(storage.flat_path("abcd1.gif"))
+    assert storage.remove("../etc") == 0